@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''
+                  AUTOMATIC TRACK SYNCHRONIZATION
+Not intended for a standalone distribution. Just a helpers collection here.
+
+Estimates the video-to-track time offset without the manual moment_track.py
+session. The video is decoded at a low resolution and a reduced rate and
+dense optical flow between the sampled frames gives two motion signals:
+    - flow magnitude, which follows the riding speed,
+    - median horizontal flow, which follows the turns (yaw rate).
+The track gives the same two: vel_filt and the heading change rate. Both
+pairs are resampled onto one time grid and cross-correlated (FFT, Pearson
+correlation over the overlapping part only) within a search window around
+the camera clock. The best lag is written in the usual offset.json format,
+so overlay_drawer.py and moment_track.py read it as is.
+
+Offset convention (the one moment_track.py saves): a frame at video
+position P maps to the track time videoStartTime + P - (diffTime + diffMS).
+'''
+
+import video_io
+import pandas as pd
+import numpy as np
+import json
+import math
+import time
+import cv2
+
+##########################################################################
+def videoMotionSignals(videoFileName, rate=5.0, width=160, startS=0, durationS=None, progressInterval=5.0, timestamps=None):
+    '''
+    Decodes [durationS] seconds of the video from [startS] keeping [rate]
+    frames per second, downscaled to [width] gray. Returns sample times
+    (seconds of video time, between two frames compared), flow magnitude
+    and yaw signal, both per second.
+
+    The frames in between are only grab()bed, which still decodes them at
+    full size. Pass a proxy (see video_io.buildProxy()) as [videoFileName]
+    and the source frame [timestamps] (ms) to decode the small proxy
+    frames instead, many times faster.
+    '''
+    cap = cv2.VideoCapture(videoFileName)
+    if not cap.isOpened():
+        raise IOError('Can\'t open ' + videoFileName)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, int(round(fps/rate)))
+    frameInd = -1
+    if not timestamps is None:
+        # Proxy frames are all keyframes, so the seek is exact and frame
+        # numbers index the timestamps
+        frameInd = int(np.searchsorted(timestamps, startS*1000)) - 1
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frameInd + 1)
+    elif startS > 0:
+        video_io.seekNear(cap, startS*1000)
+
+    times, magnitude, yaw = [], [], []
+    prev, prevMS = None, None
+    lastPrint = time.time()
+    while cap.grab():
+        frameInd += 1
+        if frameInd % step != 0:
+            continue
+        if timestamps is None:
+            posMS = cap.get(cv2.CAP_PROP_POS_MSEC)
+        elif frameInd < len(timestamps):
+            posMS = timestamps[frameInd]
+        else:
+            break
+        if posMS < startS*1000:
+            continue
+        if not durationS is None and posMS >= (startS + durationS)*1000:
+            break
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+
+        h = max(1, int(round(frame.shape[0]*width/float(frame.shape[1]))))
+        small = cv2.cvtColor(cv2.resize(frame, (width, h), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if not prev is None and posMS > prevMS:
+            flow = cv2.calcOpticalFlowFarneback(prev, small, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+            dt = (posMS - prevMS)/1000.0
+            times.append((posMS + prevMS)/2000.0)
+            magnitude.append(np.median(np.hypot(flow[:, :, 0], flow[:, :, 1]))/dt)
+            # Turning right moves the scene to the left
+            yaw.append(-np.median(flow[:, :, 0])/dt)
+        prev, prevMS = small, posMS
+
+        if time.time() - lastPrint >= progressInterval:
+            print('Analysing video: %d s' % int(posMS/1000))
+            lastPrint = time.time()
+    cap.release()
+    return np.array(times), np.array(magnitude), np.array(yaw)
+##########################################################################
+def trackMotionSignals(df, minMoveM=0.5):
+    '''
+    Track times (epoch seconds), speed (vel_filt) and heading change rate
+    (deg/s, positive when turning right). Heading is left unchanged across
+    points closer than [minMoveM], where it's mostly GPS noise.
+    '''
+    t = df['timestamp'].to_numpy().astype(np.float64)
+    x = df['x'].to_numpy()
+    y = df['y'].to_numpy()
+    speed = df['vel_filt'].to_numpy().astype(np.float64)
+
+    dx, dy = np.diff(x), np.diff(y)
+    moving = np.hypot(dx, dy) >= minMoveM
+    heading = np.zeros(len(dx))
+    heading[moving] = np.arctan2(dx[moving], dy[moving])
+    # Carry the last known heading over the stops
+    last = np.maximum.accumulate(np.where(moving, np.arange(len(dx)), 0))
+    heading = np.unwrap(heading[last])
+    dt = np.diff(t)
+    rate = np.zeros(len(t))
+    if len(heading) > 1:
+        dh = np.diff(heading)
+        dtt = (dt[1:] + dt[:-1])/2
+        rate[1:-1] = np.where(dtt > 0, np.degrees(dh)/np.maximum(dtt, 1e-9), 0)
+    return t, speed, rate
+##########################################################################
+def _resample(t, v, grid, maxGapS=None):
+    '''
+    Linear resampling onto [grid] plus the validity mask: grid points
+    outside [t] or inside a gap longer than [maxGapS] are invalid.
+    '''
+    out = np.interp(grid, t, v)
+    valid = (grid >= t[0]) & (grid <= t[-1])
+    if not maxGapS is None and len(t) > 1:
+        i = np.clip(np.searchsorted(t, grid), 1, len(t) - 1)
+        valid &= (t[i] - t[i - 1]) <= maxGapS
+    return out, valid
+##########################################################################
+def _smooth(v, radius):
+    if radius < 1:
+        return v
+    k = np.ones(2*radius + 1)/(2*radius + 1)
+    return np.convolve(v, k, mode='same')
+##########################################################################
+def _xcorr(a, b, nfft):
+    # sum_n a[n]*b[n + s] for s = -(len(a) - 1)..len(b) - 1
+    c = np.fft.irfft(np.conj(np.fft.rfft(a, nfft))*np.fft.rfft(b, nfft), nfft)
+    return np.concatenate((c[nfft - (len(a) - 1):], c[:len(b)]))
+##########################################################################
+def maskedCorrelation(a, ma, b, mb):
+    '''
+    Pearson correlation of a[n] and b[n + s] over the samples valid in both
+    ([ma], [mb] masks), for every shift s from -(len(a) - 1) to
+    len(b) - 1. Returns the correlations and the overlap sample counts.
+    '''
+    nfft = 1 << int(math.ceil(math.log2(len(a) + len(b) - 1)))
+    ma = ma.astype(np.float64)
+    mb = mb.astype(np.float64)
+    a = np.where(ma > 0, a, 0.0)
+    b = np.where(mb > 0, b, 0.0)
+
+    n = np.round(_xcorr(ma, mb, nfft))
+    sa = _xcorr(a, mb, nfft)
+    sb = _xcorr(ma, b, nfft)
+    saa = _xcorr(a*a, mb, nfft)
+    sbb = _xcorr(ma, b*b, nfft)
+    sab = _xcorr(a, b, nfft)
+
+    nn = np.maximum(n, 1)
+    cov = sab - sa*sb/nn
+    var = np.maximum(saa - sa*sa/nn, 0)*np.maximum(sbb - sb*sb/nn, 0)
+    corr = np.where((n > 2) & (var > 1e-12), cov/np.sqrt(np.maximum(var, 1e-24)), 0.0)
+    return corr, n
+##########################################################################
+def findOffset(videoTimes, videoMag, videoYaw, trackTimes, trackSpeed, trackYaw, videoStartS,
+               rate=5.0, searchWindowS=50400, centerS=0, minOverlap=0.5, weights=(1.0, 1.0), smoothS=1.0):
+    '''
+    Cross-correlates the video and track signals. [videoStartS] is the
+    camera clock video start (epoch seconds). Lags within [searchWindowS]
+    of [centerS] with at least [minOverlap] of the video signal overlapping
+    the track are considered. [weights] are the speed and yaw parts weights.
+
+    Returns a dict: the offset (seconds, diffTime + diffMS in total), the
+    combined score, the best score outside the peak, the confidence (their
+    difference), the separate speed and yaw correlations at the peak.
+    '''
+    if len(videoTimes) < 3:
+        raise ValueError('Not enough video samples to sync')
+    step = 1.0/rate
+    vGrid = np.arange(videoTimes[0], videoTimes[-1], step)
+    tGrid = np.arange(trackTimes[0], trackTimes[-1], step)
+    radius = int(round(smoothS*rate/2))
+
+    def prepare(t, v, grid, maxGapS):
+        r, m = _resample(t, v, grid, maxGapS)
+        return _smooth(r, radius), m
+
+    vMag, vMask = prepare(videoTimes, videoMag, vGrid, 2.0)
+    vYaw, _ = prepare(videoTimes, videoYaw, vGrid, 2.0)
+    tSpeed, tMask = prepare(trackTimes, trackSpeed, tGrid, 5.0)
+    tYaw, _ = prepare(trackTimes, trackYaw, tGrid, 5.0)
+
+    cSpeed, overlap = maskedCorrelation(vMag, vMask, tSpeed, tMask)
+    cYaw, _ = maskedCorrelation(vYaw, vMask, tYaw, tMask)
+    score = (weights[0]*cSpeed + weights[1]*cYaw)/float(weights[0] + weights[1])
+
+    # Shift s matches video sample n with track sample n + s
+    shifts = np.arange(-(len(vGrid) - 1), len(tGrid))
+    offsets = (videoStartS + vGrid[0]) - (tGrid[0] + shifts*step)
+    ok = (np.abs(offsets - centerS) <= searchWindowS) & (overlap >= minOverlap*vMask.sum())
+    if not ok.any():
+        raise ValueError('Video and track don\'t overlap within the search window')
+    score = np.where(ok, score, -np.inf)
+    best = int(np.argmax(score))
+
+    # Sub-sample peak position
+    frac = 0.0
+    if 0 < best < len(score) - 1 and np.isfinite(score[best - 1]) and np.isfinite(score[best + 1]):
+        denom = score[best - 1] - 2*score[best] + score[best + 1]
+        if denom < 0:
+            frac = 0.5*(score[best - 1] - score[best + 1])/denom
+    offset = offsets[best] - frac*step
+
+    # Best competitor away from the peak
+    exclude = int(round(2.0*rate))
+    rest = score.copy()
+    rest[max(0, best - exclude):best + exclude + 1] = -np.inf
+    second = float(rest.max()) if np.isfinite(rest).any() else 0.0
+    peak = float(score[best])
+    return {
+        'offsetS': float(offset),
+        'score': peak,
+        'secondScore': second,
+        'confidence': float(np.clip(peak - max(second, 0.0), 0.0, 1.0)),
+        'speedCorr': float(cSpeed[best]),
+        'yawCorr': float(cYaw[best]),
+        'overlapS': float(overlap[best]*step),
+        }
+##########################################################################
+def autoSync(videoFileName, videoStartTime, df, rate=5.0, width=160, searchWindowS=50400, centerS=0,
+             startS=0, durationS=None, weights=(1.0, 1.0), timestamps=None):
+    '''
+    The whole thing: video and track signals, then findOffset(). Analysing
+    a few minutes of a clip ([startS], [durationS]) is usually enough. The
+    default search window of 14 hours covers a camera clock set to any
+    time zone. [timestamps]: see videoMotionSignals().
+    '''
+    videoTimes, videoMag, videoYaw = videoMotionSignals(videoFileName, rate, width, startS, durationS, timestamps=timestamps)
+    trackTimes, trackSpeed, trackYaw = trackMotionSignals(df)
+    videoStartS = (np.datetime64(videoStartTime, 'ms') - np.datetime64(0, 'ms')).astype(np.int64)/1000.0
+    return findOffset(videoTimes, videoMag, videoYaw, trackTimes, trackSpeed, trackYaw, videoStartS,
+                      rate, searchWindowS, centerS, weights=weights)
+##########################################################################
+def offsetFields(offsetS):
+    '''
+    Splits the offset into the offset.json diffTime (whole seconds, as a
+    timedelta string) and diffMS (0..999) fields.
+    '''
+    totalMS = int(round(offsetS*1000))
+    seconds = totalMS//1000
+    return str(pd.to_timedelta(seconds, unit='s')), totalMS - seconds*1000
+##########################################################################
+def saveOffset(offsetFileName, result):
+    diffTime, diffMS = offsetFields(result['offsetS'])
+    data = {'diffTime': diffTime, 'diffMS': diffMS, 'autoSync': result}
+    with open(offsetFileName, 'w') as f:
+        json.dump(data, f)
+##########################################################################
+if __name__ == '__main__':
+    # Test section
+    import strava_gpx as strava
+    df = strava.readGPX('downhill.gpx')
+    result = autoSync('e:/ph/Sochi-2019/video/2019_0923_123806_025.MOV', np.datetime64('2019-09-23 12:38:06'), df, durationS=300)
+    print(result)
+    print(offsetFields(result['offsetS']))
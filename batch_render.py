@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+'''
+                    BATCH OVERLAY RENDERER
+Command line batch mode for overlay_drawer.py: renders every clip listed in
+a JSON manifest, several clips at a time.
+
+    python batch_render.py weekend.json --workers 4
+
+Manifest example (relative paths are relative to the manifest itself):
+
+    {
+        "defaults": {"preset": "default", "writerBackend": "ffmpeg", "ffmpegPreset": "veryfast"},
+        "jobs": [
+            {
+                "name": "clip025",
+                "video": "video/2019_0923_123806_025.MOV",
+                "startTime": "2019-09-23 12:38:06",
+                "gpx": "downhill.gpx",
+                "offset": "offset_025.json",
+                "start": "0:13:11",
+                "end": "0:14:35",
+                "outFile": "out/clip025.mp4"
+            }
+        ]
+    }
+
+"start"/"end" are seconds or "h:m:s" strings, "preset" is one of PRESETS
+below. Any other key is passed to overlay_drawer.renderClip() as is, so the
+rest of its Settings (outputMode, forcedWidth, ffmpegCRF...) work too, per
+job or in "defaults". The track cache (trackCacheDir) lives next to the
+manifest too, and profile reports default to <output>.profile.json. An
+overlay job without "overlayFile" writes into <name>_overlay.
+
+Every track is parsed once up front and shared by all the clips using it
+(through the track cache, or handed to the jobs directly if the cache is
+off). Job status and timing go to <manifest>.status.json after every job;
+jobs that are done and haven't changed since are skipped on rerun.
+
+Prerequisites: same as overlay_drawer.py
+'''
+
+import overlay_drawer
+import track_cache
+import numpy as np
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from widgets import Speedometer, Map, HeartRate
+
+##########################################################################
+# Widget presets. Functions, so every job gets its own fresh widgets
+PRESETS = {
+    'default': lambda: [
+            Speedometer.IMPL01(pos=(100, 600), scale=1.0),
+            Map.IMPL02(pos=(1100, 50), size=(800, 800)),
+            HeartRate.IMPL01(pos=(1600, 900), scale=1.0)
+            ],
+    'speed': lambda: [
+            Speedometer.IMPL01(pos=(100, 600), scale=1.0),
+            HeartRate.IMPL01(pos=(1600, 900), scale=1.0)
+            ],
+    'map': lambda: [
+            Map.IMPL02(pos=(1100, 50), size=(800, 800))
+            ],
+    }
+
+# Manifest keys translated into renderClip() parameters
+MANIFEST_KEYS = {
+    'video': 'videoFileName',
+    'gpx': 'trackFileName',
+    'offset': 'offsetFileName',
+    }
+PATH_KEYS = ['videoFileName', 'trackFileName', 'offsetFileName', 'outFile', 'overlayFile', 'trackCacheDir', 'profileReport']
+
+##########################################################################
+def parseTiming(t):
+    '''
+    Seconds from a number or a "h:m:s" / "m:s" string.
+    '''
+    if isinstance(t, str):
+        secs = 0.0
+        for part in t.split(':'):
+            secs = secs*60 + float(part)
+        return int(secs)
+    return int(t)
+##########################################################################
+def loadManifest(filename):
+    '''
+    Reads the manifest and returns the list of jobs: dicts of renderClip()
+    parameters plus 'name' and 'preset'.
+    '''
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    baseDir = os.path.dirname(os.path.abspath(filename))
+    defaults = manifest.get('defaults', {})
+
+    jobs = []
+    for i, entry in enumerate(manifest['jobs']):
+        job = dict(defaults)
+        job.update(entry)
+        for src, dst in MANIFEST_KEYS.items():
+            if src in job:
+                job[dst] = job.pop(src)
+        job['videoStartTime'] = job.pop('startTime')
+        job['timingStart'] = parseTiming(job.pop('start'))
+        job['timingEnd'] = parseTiming(job.pop('end'))
+        job.setdefault('name', os.path.splitext(os.path.basename(job['outFile']))[0] if 'outFile' in job else 'job%03d' % i)
+        job.setdefault('preset', 'default')
+        job.setdefault('offsetFileName', 'offset.json')
+        job.setdefault('trackCacheDir', '.track_cache')
+        # Jobs run in parallel, so each overlay gets its own directory
+        if job.get('outputMode', 'video') == 'overlay':
+            job.setdefault('overlayFile', job['name'] + '_overlay')
+            job.setdefault('outFile', None)
+        if not job['preset'] in PRESETS:
+            raise ValueError('%s: unknown widget preset \'%s\'' % (job['name'], job['preset']))
+        for k in PATH_KEYS:
+            if k in job and not job[k] is None:
+                job[k] = os.path.join(baseDir, job[k])
+        # And its own profile report
+        job.setdefault('profileReport', os.path.splitext(jobOutput(job))[0] + '.profile.json')
+        jobs.append(job)
+
+    names = [j['name'] for j in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('Job names must be unique')
+    return jobs
+##########################################################################
+def jobSignature(job):
+    '''
+    Hash of the job parameters and the input files state: a job with the
+    same signature as the last successful run doesn't need re-rendering.
+    '''
+    inputs = {}
+    for k in ('videoFileName', 'trackFileName', 'offsetFileName'):
+        try:
+            st = os.stat(job[k])
+            inputs[k] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            inputs[k] = None
+    data = json.dumps({'job': job, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+##########################################################################
+def jobOutput(job):
+    return job['overlayFile'] if job.get('outputMode', 'video') == 'overlay' else job['outFile']
+##########################################################################
+def isDone(job, status):
+    last = status.get(job['name'])
+    return (not last is None and last['status'] == 'done' and
+            last['signature'] == jobSignature(job) and os.path.exists(jobOutput(job)))
+##########################################################################
+def readStatus(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except:
+        return {}
+##########################################################################
+def writeStatus(filename, status):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp, filename)
+##########################################################################
+def runJob(args):
+    '''
+    Renders a single job and reports how it went. Never raises: a failed
+    clip shouldn't take the whole batch down.
+    '''
+    job, df, overrides = args
+    # No preview windows from pool workers or headless machines
+    params = dict(job, preview=False, **overrides)
+    name = params.pop('name')
+    preset = params.pop('preset')
+    params['videoStartTime'] = np.datetime64(params['videoStartTime'])
+
+    t = time.time()
+    result = {'name': name, 'signature': jobSignature(job), 'output': jobOutput(job), 'started': t}
+    try:
+        widgets = PRESETS[preset]()
+        stats = overlay_drawer.renderClip(widgets=widgets, df=df, **params)
+        result.update(status='done', frames=int(stats['frames']))
+    except Exception:
+        result.update(status='failed', error=traceback.format_exc())
+    result['seconds'] = round(time.time() - t, 3)
+    if result.get('frames') and result['seconds'] > 0:
+        result['fps'] = round(result['frames']/result['seconds'], 2)
+    return result
+##########################################################################
+def trackKey(job):
+    '''
+    What a parsed track depends on: jobs with equal keys share it.
+    '''
+    return (job['trackFileName'], job['trackCacheDir'],
+            job.get('speedSmoothing', 'window'), job.get('speedSmoothingRadius', 1))
+##########################################################################
+def runBatch(jobs, statusFile, workers, force=False):
+    status = readStatus(statusFile)
+    todo = [j for j in jobs if force or not isDone(j, status)]
+    for j in jobs:
+        if not j in todo:
+            print('Skipping %s: already done' % j['name'])
+    if len(todo) == 0:
+        return status
+
+    # Parse every track once. With the cache on, the workers just map the
+    # cached columns; otherwise the parsed tracks go to the jobs as is
+    tracks = {}
+    for j in todo:
+        key = trackKey(j)
+        if key in tracks:
+            continue
+        gpx, cacheDir, smoothing, smoothingRadius = key
+        print('Reading track', gpx)
+        df = track_cache.readGPXCached(gpx, cacheDir=cacheDir, interpolateToSeconds=False,
+                                       smoothing=smoothing, smoothingRadius=smoothingRadius)
+        tracks[key] = df if cacheDir is None else None
+
+    # Pool workers can't have child processes of their own
+    overrides = {'renderWorkers': 0, 'renderSegments': 1} if workers > 1 else {}
+    tasks = [(j, tracks[trackKey(j)], overrides) for j in todo]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=min(workers, len(tasks)))
+        results = pool.imap_unordered(runJob, tasks)
+    else:
+        pool = None
+        results = map(runJob, tasks)
+
+    try:
+        for r in results:
+            status[r['name']] = r
+            writeStatus(statusFile, status)
+            print('Job %s: %s in %.1f s' % (r['name'], r['status'], r['seconds']))
+    finally:
+        if not pool is None:
+            pool.close()
+            pool.join()
+    return status
+##########################################################################
+def printSummary(jobs, status):
+    print('\n%-24s %-8s %8s %8s %8s' % ('job', 'status', 'frames', 'seconds', 'fps'))
+    for j in jobs:
+        r = status.get(j['name'], {})
+        print('%-24s %-8s %8s %8s %8s' % (j['name'], r.get('status', '-'), r.get('frames', '-'), r.get('seconds', '-'), r.get('fps', '-')))
+        if r.get('status') == 'failed':
+            print(r['error'])
+##########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Renders overlays for all the clips listed in a JSON manifest.')
+    parser.add_argument('manifest', help='JSON manifest file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='clips rendered at once (default: CPU count)')
+    parser.add_argument('--status', default=None, help='status file (default: <manifest>.status.json)')
+    parser.add_argument('--force', action='store_true', help='re-render the jobs that are already done')
+    parser.add_argument('--dry-run', action='store_true', help='only list what would be rendered')
+    args = parser.parse_args()
+
+    jobs = loadManifest(args.manifest)
+    statusFile = args.status or os.path.splitext(args.manifest)[0] + '.status.json'
+
+    if args.dry_run:
+        status = readStatus(statusFile)
+        for j in jobs:
+            print('%-24s %s' % (j['name'], 'done' if isDone(j, status) and not args.force else 'to render'))
+    else:
+        status = runBatch(jobs, statusFile, args.workers, args.force)
+        printSummary(jobs, status)
+        if any(status.get(j['name'], {}).get('status') != 'done' for j in jobs):
+            sys.exit(1)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+'''
+                    BENCHMARK SUITE
+Times the pipeline stages on synthetic data, so no real footage or track
+is needed:
+    - GPX parsing (plain and through the track cache)
+    - per-frame telemetry lookup
+    - each widget's prepare() and per-frame drawing
+    - colour conversion (the full-frame PIL round trip)
+    - end-to-end rendering frames/sec of overlay_drawer.renderClip()
+
+    python benchmark.py --out before.json
+    python benchmark.py --out after.json --compare before.json
+
+Synthetic GPX files (configurable length and sensor mix) and videos
+(1080p/4K, 30/60 fps) are generated into --data-dir and reused on the next
+runs. Results are plain JSON: {"meta": {...}, "results": {name: {...}}},
+every result has a "value" and a "unit". Stages that didn't run (--no-video,
+or e.g. an OpenCV build that can't write the synthetic video) are listed in
+meta "skipped" with the reason instead.
+
+Prerequisites: same as overlay_drawer.py
+'''
+
+import strava_gpx as strava
+import track_cache
+import overlay_drawer
+import render
+import numpy as np
+import pandas as pd
+import PIL
+import cv2
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+from widgets import Speedometer, Map, HeartRate
+
+SIZES = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+SENSORS = ('hr', 'cad', 'power')
+START_TIME = '2019-09-23T09:00:00'
+
+# Widgets to time, one of each kind, laid out for 1080p
+WIDGETS = {
+    'Speedometer': lambda: Speedometer.IMPL01(pos=(100, 600), scale=1.0),
+    'Map': lambda: Map.IMPL02(pos=(1100, 50), size=(800, 800)),
+    'HeartRate': lambda: HeartRate.IMPL01(pos=(1600, 900), scale=1.0),
+    }
+
+##########################################################################
+def makeSyntheticGPX(filename, points=3600, sensors=SENSORS, segments=1, seed=0):
+    '''
+    Writes a Strava-like GPX track of [points] one-second samples split into
+    [segments] track segments. [sensors] is any subset of 'hr', 'cad' and
+    'power'; the extensions block is omitted altogether without sensors.
+    The route is a smooth random walk at 3..15 m/s.
+    '''
+    rng = np.random.RandomState(seed)
+    heading = np.cumsum(rng.normal(0, 0.05, points))
+    speed = 9 + 6*np.sin(np.arange(points)/97.0)
+    dist = speed*1.0
+    lat = 43.6 + np.cumsum(dist*np.cos(heading))/111320.0
+    lon = 39.7 + np.cumsum(dist*np.sin(heading))/(111320.0*math.cos(math.radians(43.6)))
+    ele = 500 + np.cumsum(rng.normal(0, 0.3, points))
+    hr = np.clip(130 + 30*np.sin(np.arange(points)/300.0) + rng.normal(0, 2, points), 60, 200).astype(int)
+    cad = np.clip(80 + rng.normal(0, 5, points), 0, 130).astype(int)
+    power = np.clip(200 + 80*np.sin(np.arange(points)/60.0) + rng.normal(0, 20, points), 0, 1200).astype(int)
+
+    t0 = np.datetime64(START_TIME)
+    perSegment = int(math.ceil(points/float(max(segments, 1))))
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx creator="StravaGPX" version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+                'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n'
+                '<metadata><time>%sZ</time></metadata>\n<trk><name>Synthetic</name><type>1</type>\n<trkseg>\n' % START_TIME)
+        gap = 0
+        for i in range(points):
+            if i > 0 and i % perSegment == 0:
+                # A minute long pause between segments
+                f.write('</trkseg>\n<trkseg>\n')
+                gap += 60
+            ext = ''
+            if len(sensors) > 0:
+                tpx = ''
+                if 'hr' in sensors:
+                    tpx += '<gpxtpx:hr>%d</gpxtpx:hr>' % hr[i]
+                if 'cad' in sensors:
+                    tpx += '<gpxtpx:cad>%d</gpxtpx:cad>' % cad[i]
+                ext = '<extensions>%s%s</extensions>' % (
+                        '<power>%d</power>' % power[i] if 'power' in sensors else '',
+                        '<gpxtpx:TrackPointExtension>%s</gpxtpx:TrackPointExtension>' % tpx if tpx else '')
+            f.write('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%sZ</time>%s</trkpt>\n' % (
+                    lat[i], lon[i], ele[i], str(t0 + np.timedelta64(i + gap, 's')), ext))
+        f.write('</trkseg>\n</trk>\n</gpx>\n')
+##########################################################################
+def makeSyntheticVideo(filename, size, fps, seconds, encoding='mp4v'):
+    '''
+    Writes a [seconds] long clip of moving gradients with the frame number
+    printed on it, via OpenCV.
+    '''
+    w, h = size
+    out = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*encoding), fps, size)
+    if not out.isOpened():
+        raise IOError('OpenCV can\'t open a \'%s\' writer for %s' % (encoding, filename))
+    gx = np.tile(np.linspace(0, 255, w, dtype=np.float32), (h, 1))
+    gy = np.tile(np.linspace(0, 255, h, dtype=np.float32)[:, None], (1, w))
+    for i in range(int(seconds*fps)):
+        frame = np.dstack([(gx + 3*i) % 256, (gy + 2*i) % 256, np.full((h, w), (5*i) % 256, np.float32)]).astype(np.uint8)
+        cv2.putText(frame, '%d' % i, (w//20, h//5), cv2.FONT_HERSHEY_SIMPLEX, h/270.0, (255, 255, 255), max(1, h//270))
+        out.write(frame)
+    out.release()
+##########################################################################
+def timeCall(fn, repeat=3):
+    '''
+    Runs [fn] [repeat] times. Returns the last result and the timing stats
+    (seconds).
+    '''
+    times = []
+    result = None
+    for _ in range(max(1, repeat)):
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+    stats = {'min': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)), 'runs': len(times)}
+    return result, stats
+##########################################################################
+def _entry(value, unit, **extra):
+    e = {'value': round(float(value), 6), 'unit': unit}
+    e.update(extra)
+    return e
+##########################################################################
+def benchTrack(gpxFile, name, repeat, results):
+    df, st = timeCall(lambda: strava.readGPX(gpxFile), repeat)
+    results['readGPX/%s' % name] = _entry(st['median'], 's', points=len(df), **st)
+
+    cacheDir = tempfile.mkdtemp(prefix='bench_cache_')
+    try:
+        _, st = timeCall(lambda: track_cache.readGPXCached(gpxFile, cacheDir=cacheDir), 1)
+        results['readGPXCached.cold/%s' % name] = _entry(st['median'], 's', **st)
+        _, st = timeCall(lambda: track_cache.readGPXCached(gpxFile, cacheDir=cacheDir), repeat)
+        results['readGPXCached.warm/%s' % name] = _entry(st['median'], 's', **st)
+    finally:
+        shutil.rmtree(cacheDir, ignore_errors=True)
+    return df
+##########################################################################
+def benchLookup(df, fps, seconds, repeat, name, results):
+    videoTime = pd.to_datetime(np.datetime64(START_TIME))
+    timeline, st = timeCall(lambda: strava.makeFrameTimeline(df, videoTime, fps, 0, seconds), repeat)
+    results['timeline.build/%s' % name] = _entry(st['median'], 's', frames=len(timeline), **st)
+
+    offsets = timeline.offsetsMS
+    _, st = timeCall(lambda: [timeline.recordForOffset(ms) for ms in offsets], repeat)
+    results['timeline.lookup/%s' % name] = _entry(st['median']/len(offsets)*1e6, 'us/frame', **st)
+    return timeline
+##########################################################################
+def benchWidgets(df, timeline, size, frames, repeat, name, results):
+    '''
+    prepare() and prepareTimeline() once per widget, then drawing over
+    [frames] consecutive frames: the layer path renderFrame() uses and the
+    legacy full-frame PIL path for comparison.
+    '''
+    base = np.full((size[1], size[0], 3), 96, np.uint8)
+    frames = min(frames, len(timeline))
+    for wName, make in WIDGETS.items():
+        w = make()
+        _, st = timeCall(lambda: w.prepare(df), 1)
+        results['widget.prepare/%s/%s' % (wName, name)] = _entry(st['median'], 's', **st)
+        _, st = timeCall(lambda: w.prepareTimeline(timeline), 1)
+        results['widget.prepareTimeline/%s/%s' % (wName, name)] = _entry(st['median'], 's', **st)
+
+        def drawLayers():
+            for i in range(frames):
+                render.renderFrame(base.copy(), [w], timeline.record(i))
+        _, st = timeCall(drawLayers, repeat)
+        results['widget.draw/%s/%s' % (wName, name)] = _entry(st['median']/frames*1000, 'ms/frame', **st)
+
+        legacyFrames = min(frames, 10)
+        def drawFullFrame():
+            for i in range(legacyFrames):
+                render._drawFullFrame(base.copy(), w, timeline.record(i))
+        _, st = timeCall(drawFullFrame, 1)
+        results['widget.drawFullFrame/%s/%s' % (wName, name)] = _entry(st['median']/legacyFrames*1000, 'ms/frame', **st)
+##########################################################################
+def benchColour(size, repeat, name, results):
+    frame = np.random.RandomState(0).randint(0, 255, (size[1], size[0], 3)).astype(np.uint8)
+
+    _, st = timeCall(lambda: cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), repeat)
+    results['colour.cvtColor/%s' % name] = _entry(st['median']*1000, 'ms/frame', **st)
+
+    def roundTrip():
+        im = PIL.Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).convert('RGBA')
+        return np.ascontiguousarray(np.array(render.pure_pil_alpha_to_color(im))[:, :, ::-1])
+    _, st = timeCall(roundTrip, repeat)
+    results['colour.pilRoundTrip/%s' % name] = _entry(st['median']*1000, 'ms/frame', **st)
+##########################################################################
+def benchEndToEnd(videoFile, gpxFile, seconds, name, results):
+    outDir = tempfile.mkdtemp(prefix='bench_out_')
+    try:
+        widgets = [make() for make in WIDGETS.values()]
+        t = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = overlay_drawer.renderClip(
+                    videoFileName=videoFile, videoStartTime=np.datetime64(START_TIME),
+                    timingStart=0, timingEnd=seconds, trackFileName=gpxFile,
+                    offsetFileName=os.path.join(outDir, 'no_offset.json'),
+                    outFile=os.path.join(outDir, 'out.mp4'), widgets=widgets,
+                    trackCacheDir=None, writerBackend='opencv', encoding='mp4v'
+                    )
+        elapsed = time.perf_counter() - t
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
+    results['render.endToEnd/%s' % name] = _entry(stats['frames']/elapsed, 'fps', frames=stats['frames'], seconds=elapsed)
+##########################################################################
+def compareResults(old, new):
+    '''
+    Prints the results present in both runs side by side. The change is
+    positive when things got better (faster, or more fps).
+    '''
+    print('%-48s %12s %12s %9s' % ('benchmark', 'old', 'new', 'change'))
+    for key in sorted(new['results']):
+        if not key in old['results']:
+            continue
+        o, n = old['results'][key], new['results'][key]
+        if o['unit'] != n['unit'] or o['value'] == 0 or n['value'] == 0:
+            continue
+        change = n['value']/o['value'] - 1 if n['unit'] == 'fps' else o['value']/n['value'] - 1
+        print('%-48s %12.4g %12.4g %+8.1f%%  %s' % (key, o['value'], n['value'], 100*change, n['unit']))
+##########################################################################
+def runSuite(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    sensors = tuple(s for s in args.sensors.split(',') if s)
+    results = {}
+    skipped = {}
+
+    gpxFiles = {}
+    for points in [int(p) for p in args.points.split(',')]:
+        name = '%dpts_%s' % (points, '-'.join(sensors) or 'nosensors')
+        gpxFile = os.path.join(args.data_dir, 'synthetic_%s.gpx' % name)
+        if not os.path.exists(gpxFile):
+            makeSyntheticGPX(gpxFile, points, sensors)
+        print('Track', name)
+        gpxFiles[name] = (gpxFile, benchTrack(gpxFile, name, args.repeat, results))
+
+    # Video dependent stages run on the longest track
+    gpxFile, df = gpxFiles[max(gpxFiles, key=lambda k: int(k.split('pts')[0]))]
+    for sizeName in args.sizes.split(','):
+        size = SIZES[sizeName]
+        benchColour(size, args.repeat, sizeName, results)
+        for fps in [int(f) for f in args.fps.split(',')]:
+            name = '%s%d' % (sizeName, fps)
+            print('Video', name)
+            timeline = benchLookup(df, fps, args.seconds, args.repeat, name, results)
+            benchWidgets(df, timeline, size, args.frames, args.repeat, name, results)
+            key = 'render.endToEnd/%s' % name
+            if args.no_video:
+                skipped[key] = '--no-video'
+                continue
+            try:
+                videoFile = os.path.join(args.data_dir, 'synthetic_%s_%ds.mp4' % (name, args.seconds))
+                if not os.path.exists(videoFile):
+                    makeSyntheticVideo(videoFile, size, fps, args.seconds)
+                benchEndToEnd(videoFile, gpxFile, args.seconds, name, results)
+            except Exception as e:
+                skipped[key] = '%s: %s' % (type(e).__name__, e)
+                print('Skipping end-to-end rendering:', skipped[key])
+
+    meta = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'opencv': cv2.__version__, 'pillow': PIL.__version__},
+        'args': vars(args),
+        'skipped': skipped,
+        }
+    return {'meta': meta, 'results': results}
+##########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the overlay pipeline stages on synthetic data.')
+    parser.add_argument('--out', default='benchmark.json', help='results file')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare with')
+    parser.add_argument('--data-dir', default='bench_data', help='where synthetic inputs are generated and reused')
+    parser.add_argument('--points', default='3600,36000', help='track lengths, comma separated (1 point per second)')
+    parser.add_argument('--sensors', default='hr,cad,power', help='sensors in the synthetic tracks, comma separated (may be empty)')
+    parser.add_argument('--sizes', default='1080p,4k', help='video sizes: ' + ', '.join(SIZES))
+    parser.add_argument('--fps', default='30,60', help='video frame rates, comma separated')
+    parser.add_argument('--seconds', type=int, default=10, help='synthetic video length')
+    parser.add_argument('--frames', type=int, default=60, help='frames per widget draw benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing')
+    parser.add_argument('--no-video', action='store_true', help='skip end-to-end rendering')
+    args = parser.parse_args()
+
+    report = runSuite(args)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to', args.out)
+
+    if not args.compare is None:
+        with open(args.compare, 'r') as f:
+            compareResults(json.load(f), report)
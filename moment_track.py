@@ -35,8 +35,11 @@ these are NOT synchronized and are running at a different speeds. So you may
 want to stop one for starter and return to it later. See "Key bindings"
 subsection of the Settings section to find out the streams control keys. These
 should be quite obvious: both can be paused/unpaused or moved one step forward
-(when on pause). Map view can also be moved one step backward, while video have
-additional option the skip several steps .
+(when on pause). Both can also be moved one step backward, and video has
+additional options to skip several frames forward or backward. Recently shown
+video frames are kept in memory ([videoBufferMB]), so stepping back over them
+is instant; further back takes a short seek. For large (4K) sources set
+[useProxy]: the first run builds a small copy of the video to scrub instead.
     When you think both streams are paused at the same moment, hit [KEY_SAVE]
 key ("Enter" by default) and you'll receive the saved offset in
 [offsetFileName] json file. You'll have to provide this file name
@@ -44,22 +47,38 @@ to overlay_drawer.py later.
     Note that one step of video stream is one frame (it's 1/30 or even 1/60 s),
 while the track step most probably is 1 s. Thus good idea to fine-tune
 the streams alignment  with the video stream, not the track one.
+    Alternatively set [autoSync] to True. The script will then estimate the
+offset itself, matching the video motion against the track speed and turns,
+save it right away and open the UI with both streams paused at the found
+position. Check the moment, fine-tune if needed and save as described above.
+The printed confidence tells how much the best match stands out: with low
+values (featureless footage, long straight rides) better don't skip the
+manual check.
     
 '''
 
-import strava_gpx as strava
+import track_cache
+import auto_sync
+import video_io
 import pandas as pd
 import numpy as np
+import hashlib
 import json
 import cv2
+import os
+from collections import OrderedDict
 
 ##########################################################################
 '''
 scale - input dictionary
 input area: (srcW * srcH), startimg from minX, minY
 output area: (dstW * dstH), starting from startX, startY
+[point] is (x, y) of scalars or of coordinate arrays. For arrays the
+result is a pair of integer arrays, see ptScaleArray
 '''
 def ptScale(scaler, point):
+    if np.ndim(point[0]) > 0:
+        return ptScaleArray(scaler, point[0], point[1])
     _scaleX = scaler['dstW']/scaler['srcW']
     _scaleY = scaler['dstH']/scaler['srcH']
     if scaler['keepAspect']:
@@ -72,12 +91,177 @@ def ptScale(scaler, point):
     return (int(scaler['startX'] + _offsX + (point[0] - scaler['minX'])*_scaleX), 
             int(scaler['startY'] + _offsY + (point[1] - scaler['minY'])*_scaleY))
 ##########################################################################
+'''
+Vectorized ptScale: [xs], [ys] are coordinate arrays, the result is a pair
+of integer arrays (truncated the same way as ptScale does).
+'''
+def ptScaleArray(scaler, xs, ys):
+    _scaleX = scaler['dstW']/scaler['srcW']
+    _scaleY = scaler['dstH']/scaler['srcH']
+    if scaler['keepAspect']:
+        _scale = min(_scaleX, _scaleY)
+        _scaleX = _scale
+        _scaleY = _scale
+    _offsX = (scaler['dstW'] - scaler['srcW']*_scaleX)/2
+    _offsY = (scaler['dstH'] - scaler['srcH']*_scaleY)/2
+    
+    return ((scaler['startX'] + _offsX + (np.asarray(xs) - scaler['minX'])*_scaleX).astype(np.int64), 
+            (scaler['startY'] + _offsY + (np.asarray(ys) - scaler['minY'])*_scaleY).astype(np.int64))
+##########################################################################
+'''
+Douglas-Peucker simplification of the [xs], [ys] polyline: indices of the
+points to keep, so that no dropped point is further than [tolerance] from
+the simplified line. Spans are split one at a time, the distances within
+a span are computed at once.
+'''
+def simplifyTrack(xs, ys, tolerance):
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    n = len(xs)
+    if n < 3:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, n - 1)]
+    while len(spans) > 0:
+        a, b = spans.pop()
+        if b - a < 2:
+            continue
+        # Distance to the span chord (segment, not the infinite line)
+        dx, dy = xs[b] - xs[a], ys[b] - ys[a]
+        px, py = xs[a + 1:b] - xs[a], ys[a + 1:b] - ys[a]
+        len2 = dx*dx + dy*dy
+        t = np.clip((px*dx + py*dy)/len2, 0, 1) if len2 > 0 else 0
+        d = np.hypot(px - t*dx, py - t*dy)
+        i = int(np.argmax(d))
+        if d[i] > tolerance:
+            m = a + 1 + i
+            keep[m] = True
+            spans.append((a, m))
+            spans.append((m, b))
+    return np.nonzero(keep)[0]
+##########################################################################
+_lodCache = OrderedDict()
+LOD_CACHE_SIZE = 16
+'''
+Indices of the track points worth drawing at [scaler]'s destination size.
+Points landing on the same pixel (as ptScaleArray maps them) as the one
+before are dropped first: that alone doesn't change the drawn line at all
+and leaves a few thousand points of any track. A positive [tolerancePx]
+additionally runs simplifyTrack() with that tolerance in pixels, which is
+fewer points still but not pixel-exact. Results are cached per (track,
+scaler, tolerance).
+'''
+def trackLOD(scaler, xs, ys, tolerancePx=0):
+    xs = np.ascontiguousarray(xs, dtype=np.float64)
+    ys = np.ascontiguousarray(ys, dtype=np.float64)
+    h = hashlib.sha1(xs.tobytes())
+    h.update(ys.tobytes())
+    key = (h.hexdigest(), tuple(sorted(scaler.items())), tolerancePx)
+    result = _lodCache.get(key)
+    if not result is None:
+        _lodCache.move_to_end(key)
+        return result
+
+    px, py = ptScaleArray(scaler, xs, ys)
+    result = np.nonzero(np.r_[True, (np.diff(px) != 0) | (np.diff(py) != 0)])[0]
+    if tolerancePx > 0:
+        scaleX = scaler['dstW']/scaler['srcW'] if scaler['srcW'] > 0 else 1.0
+        scaleY = scaler['dstH']/scaler['srcH'] if scaler['srcH'] > 0 else 1.0
+        scale = min(scaleX, scaleY) if scaler['keepAspect'] else max(scaleX, scaleY)
+        result = result[simplifyTrack(xs[result], ys[result], tolerancePx/scale)]
+    _lodCache[key] = result
+    if len(_lodCache) > LOD_CACHE_SIZE:
+        _lodCache.popitem(last=False)
+    return result
+##########################################################################
+class ZoomedTrackView:
+    '''
+    Zoomed track map of [scaler]'s destination size, rendered on demand
+    instead of being kept as one huge image. The map is split into
+    [tileSize] square tiles; a tile is drawn the first time it's needed,
+    from the track segments crossing it only, and at most [maxTiles] of
+    them are kept (least recently used go first). Memory use doesn't depend
+    on the zoom level.
+    '''
+    def __init__(self, xs, ys, scaler, tileSize=256, maxTiles=64, color=(255, 255, 255)):
+        self.width = int(scaler['dstW'])
+        self.height = int(scaler['dstH'])
+        self.tileSize = tileSize
+        self.maxTiles = maxTiles
+        self.color = color
+        px, py = ptScaleArray(scaler, xs, ys)
+        self.px = px
+        self.py = self.height - py
+        # Segment i goes from point i to point i + 1
+        self.segMinX = np.minimum(self.px[:-1], self.px[1:])
+        self.segMaxX = np.maximum(self.px[:-1], self.px[1:])
+        self.segMinY = np.minimum(self.py[:-1], self.py[1:])
+        self.segMaxY = np.maximum(self.py[:-1], self.py[1:])
+        self.tiles = OrderedDict()
+# ------------------------------------------------------------------------
+    def _renderTile(self, tx, ty):
+        # Drawn with a margin: lines clipped right at the tile border get
+        # antialiased a bit differently from the same lines drawn whole
+        pad = 8
+        size = self.tileSize + 2*pad
+        tile = np.zeros((size, size, 3), dtype=np.uint8)
+        x0, y0 = tx*self.tileSize - pad, ty*self.tileSize - pad
+        hit = np.nonzero((self.segMaxX >= x0) & (self.segMinX < x0 + size) &
+                         (self.segMaxY >= y0) & (self.segMinY < y0 + size))[0]
+        if len(hit) > 0:
+            # Consecutive segments make one polyline
+            breaks = np.nonzero(np.diff(hit) > 1)[0] + 1
+            lines = []
+            for run in np.split(hit, breaks):
+                ind = np.append(run, run[-1] + 1)
+                lines.append(np.stack([self.px[ind] - x0, self.py[ind] - y0], axis=1).astype(np.int32))
+            cv2.polylines(tile, lines, False, self.color, thickness=1, lineType=cv2.LINE_AA)
+        return np.ascontiguousarray(tile[pad:-pad, pad:-pad])
+# ------------------------------------------------------------------------
+    def tile(self, tx, ty):
+        key = (tx, ty)
+        t = self.tiles.get(key)
+        if t is None:
+            t = self._renderTile(tx, ty)
+            self.tiles[key] = t
+            if len(self.tiles) > self.maxTiles:
+                self.tiles.popitem(last=False)
+        else:
+            self.tiles.move_to_end(key)
+        return t
+# ------------------------------------------------------------------------
+    def view(self, x, y, w, h):
+        '''
+        The [w]x[h] window of the zoomed map with the top-left corner at
+        ([x], [y]), same as slicing the whole map image would give.
+        '''
+        out = np.zeros((h, w, 3), dtype=np.uint8)
+        ts = self.tileSize
+        for ty in range(max(y, 0)//ts, (min(y + h, self.height) - 1)//ts + 1):
+            for tx in range(max(x, 0)//ts, (min(x + w, self.width) - 1)//ts + 1):
+                # Tile and window overlap in map coordinates
+                ox0, oy0 = max(tx*ts, x), max(ty*ts, y)
+                ox1, oy1 = min((tx + 1)*ts, x + w, self.width), min((ty + 1)*ts, y + h, self.height)
+                if ox1 <= ox0 or oy1 <= oy0:
+                    continue
+                out[(oy0 - y):(oy1 - y), (ox0 - x):(ox1 - x)] = self.tile(tx, ty)[(oy0 - ty*ts):(oy1 - ty*ts), (ox0 - tx*ts):(ox1 - tx*ts)]
+        return out
+##########################################################################
 if __name__ == '__main__':
     # ------- Settings -------
     
     # Input track file name. Should be track saved from Strava via "Export GPX"
     # function (assuming it works the same way as at November 2019)
     trackFileName = 'downhill.gpx'
+
+    # Parsed track cache directory. Set to None to parse the GPX on every run
+    trackCacheDir = '.track_cache'
+    
+    # Track speed smoothing, see the same settings of overlay_drawer.py.
+    # Used by autoSync
+    speedSmoothing = 'window'
+    speedSmoothingRadius = 1
     
     # Input video file name. No strict requirements as long as OpenCV can read it
     videoFileName = 'e:/ph/Sochi-2019/video/2019_0923_123806_025.MOV'
@@ -88,6 +272,22 @@ if __name__ == '__main__':
     # Video start time. Usually comes from file naming of attributes
     videoStartTime = np.datetime64('2019-09-23 12:38:06')
     
+    # Automatic sync. The offset is estimated by correlating the video
+    # motion (optical flow) with the track speed and turns, and saved to
+    # offsetFileName. The UI then opens paused at the found position, so
+    # the result can be checked and refined manually as usual
+    autoSync = False
+    # Analysed frames per second and frame width
+    autoSyncRate = 5.0
+    autoSyncWidth = 160
+    # Offsets searched: videoStartTime clock error up to this many seconds.
+    # 14 hours cover a camera clock set to any time zone; the search costs
+    # the same whatever the window
+    autoSyncWindowS = 50400
+    # Part of the video to analyse (seconds). A few minutes is usually enough
+    autoSyncStartS = 0
+    autoSyncDurationS = 300
+    
     # Displaying parameters
     
     # On-screen image size (consider it window size)
@@ -97,6 +297,11 @@ if __name__ == '__main__':
     # Probably you don't need to change this.
     zoomScale = 1.0
     
+    # Zoomed map is drawn on demand in square tiles of this size, with at
+    # most this many tiles kept in memory
+    zoomTileSize = 256
+    zoomMaxTiles = 64
+    
     # Zoomed window size and position
     zoomedSize = (400, 300)
     zoomedPos = (100, 100)
@@ -105,6 +310,16 @@ if __name__ == '__main__':
     videoFitSize = (300, 300)
     videoWindowPos = (100, 600)
     
+    # Decoded video frames kept for stepping back, MB. Going back further
+    # than that seeks to the previous keyframe and decodes from there
+    videoBufferMB = 256
+    
+    # Play a low-resolution proxy of the video instead of decoding the
+    # source at full resolution. It's built on the first run (decoding the
+    # whole video once) and kept next to offsetFileName; saved offsets
+    # still refer to the source video timestamps
+    useProxy = False
+    
     # Key bindings
     KEY_QUIT                = ord('q') # Q
     KEY_SAVE                = 13       # <Enter>
@@ -114,18 +329,22 @@ if __name__ == '__main__':
     KEY_TRACK_STEP_BACK     = ord('-') # -
     KEY_VIDEO_NEXT_FRAME    = ord('z') # Z
     KEY_VIDEO_SKIP_N_FRAMES = ord('x') # X
+    KEY_VIDEO_PREV_FRAME    = ord('a') # A
+    KEY_VIDEO_BACK_N_FRAMES = ord('s') # S
     frames2skipN = 30
     # ------- End of settings -------
     
-    df = strava.readGPX(trackFileName, interpolateToSeconds=False)
+    df = track_cache.readGPXCached(trackFileName, cacheDir=trackCacheDir, interpolateToSeconds=False,
+                                   smoothing=speedSmoothing, smoothingRadius=speedSmoothingRadius)
     
-    cap = cv2.VideoCapture(videoFileName)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    scaleX = float(videoFitSize[0])/width
-    scaleY = float(videoFitSize[1])/height
-    scale = min(scaleX, scaleY)
-    videoSize = (int(width*scale), int(height*scale))
+    if useProxy:
+        print('Loading proxy')
+        proxyFile, timestamps = video_io.loadProxy(videoFileName, os.path.dirname(os.path.abspath(offsetFileName)), videoFitSize)
+        video = video_io.ScrubReader(proxyFile, videoFitSize, videoBufferMB, timestamps)
+    else:
+        print('Indexing video')
+        video = video_io.ScrubReader(videoFileName, videoFitSize, videoBufferMB)
+    videoSize = video.size
     
 
     print('HR: ', df['hr'].min(), ':', df['hr'].max())
@@ -153,42 +372,53 @@ if __name__ == '__main__':
 
     zoomedW = int(zoomScale*10000)
     zoomedH = int(zoomScale*10000)
-    zoomedMap = np.ndarray((zoomedH, zoomedW, 3), dtype=np.uint8)
-    zoomedMap.fill(0)
     zoomScaler = scaler.copy()
     scaler['startX'] = 0
     scaler['startY'] = 0
     zoomScaler['dstW'] = zoomedW
     zoomScaler['dstH'] = zoomedH
+    trackX = df['x'].to_numpy()
+    trackY = df['y'].to_numpy()
+    keep = trackLOD(zoomScaler, trackX, trackY)
+    zoomView = ZoomedTrackView(trackX[keep], trackY[keep], zoomScaler, zoomTileSize, zoomMaxTiles)
     
     
     print('Building map')
-    prevX = None
-    prevY = None
-    prevZoomX = None
-    prevZoomY = None
-    for ind, row in df.iterrows():
-        # Normal map
-        x, y = ptScale(scaler, (row['x'], row['y']))
-        y = imageSize[1] - y
-        if not prevX == None and not prevY == None:
-            cv2.line(mapFrame, (x, y), (prevX, prevY), [255, 255, 255], thickness=1, lineType=cv2.LINE_AA)
-        prevX = x
-        prevY = y
-
-        # Zoomed map
-        zx, zy = ptScale(zoomScaler, (row['x'], row['y']))
-        zy = zoomedH - zy
-        if not prevZoomX == None and not prevZoomY == None:
-            cv2.line(zoomedMap, (zx, zy), (prevZoomX, prevZoomY), [255, 255, 255], thickness=1, lineType=cv2.LINE_AA)
-        prevZoomX = zx
-        prevZoomY = zy
+    keep = trackLOD(scaler, trackX, trackY)
+    xs, ys = ptScale(scaler, (trackX[keep], trackY[keep]))
+    mapPoints = np.stack([xs, imageSize[1] - ys], axis=1).astype(np.int32)
+    cv2.polylines(mapFrame, [mapPoints], False, [255, 255, 255], thickness=1, lineType=cv2.LINE_AA)
     
     #cv2.imwrite('map.jpg', mapFrame)
-    #cv2.imwrite('map_big.jpg', zoomedMap)
 
     print('Displaying map')
-    videoFrameInd = -1
+    ind = 0
+    isPausedTrack = False
+    isPausedVideo = False
+    
+    if autoSync:
+        print('Auto syncing...')
+        # The proxy decodes much faster, if there's one
+        result = auto_sync.autoSync(
+                proxyFile if useProxy else videoFileName, videoStartTime, df, autoSyncRate, autoSyncWidth,
+                autoSyncWindowS, startS=autoSyncStartS, durationS=autoSyncDurationS,
+                timestamps=timestamps if useProxy else None
+                )
+        diffTime, diffMS = auto_sync.offsetFields(result['offsetS'])
+        print('Found time diff:', diffTime, '+', diffMS, 'MS')
+        print('Correlation: %.3f, confidence: %.3f' % (result['score'], result['confidence']))
+        auto_sync.saveOffset(offsetFileName, result)
+        print('Offset saved to ' + offsetFileName)
+        
+        # Start both streams paused at the found position: the analysed
+        # part's start, or later if the track starts after it
+        videoStartS = (np.datetime64(videoStartTime, 'ms') - np.datetime64(0, 'ms')).astype(np.int64)/1000.0
+        trackStartS = float(df['timestamp'].iloc[0])
+        posS = max(autoSyncStartS, trackStartS - (videoStartS - result['offsetS']))
+        video.seek(int(round(posS*video.fps)))
+        ind = int(np.clip(np.argmin(np.abs(df['timestamp'].to_numpy() - (videoStartS - result['offsetS'] + posS))), 0, df.shape[0] - 2))
+        isPausedTrack = True
+        isPausedVideo = True
     
     zoomedPosX = zoomedPos[0]
     zoomedPosY = zoomedPos[1]
@@ -197,24 +427,15 @@ if __name__ == '__main__':
     zoomDX = zoomedRX*2
     zoomDY = zoomedRY*2
     
-    ind = 0
-    isPausedTrack = False
-    isPausedVideo = False
-    isFinishedVideo = not cap.isOpened()
-    videoFrame = None
-    resizedVideoFrame = None
+    isFinishedVideo = False
     while True:
         # Track step
         if not isPausedTrack and ind < df.shape[0] - 2:
             ind += 1
         row = df.iloc[ind]
         # Video step
-        if (not isFinishedVideo) and ((videoFrame is None) or not isPausedVideo):
-            ret, videoFrame = cap.read()
-            isFinishedVideo = not ret
-            if not isFinishedVideo:
-                resizedVideoFrame = cv2.resize(videoFrame, videoSize, interpolation=cv2.INTER_AREA)
-                videoFrameInd += 1
+        if (not isFinishedVideo) and ((video.frame is None) or not isPausedVideo):
+            isFinishedVideo = not video.step()
         
         x, y = ptScale(scaler, (row['x'], row['y']))
         y = imageSize[1] - y
@@ -242,13 +463,13 @@ if __name__ == '__main__':
         elif zoomedStartY + zoomDY >= zoomedH:
             zShiftY = zoomedH - zoomDY - zoomedStartY - 1
             zoomedStartY = zoomedStartY + zShiftY
-        curFrame[zoomedPosY:(zoomDY + zoomedPosY):, zoomedPosX:(zoomDX + zoomedPosX):, ::] = zoomedMap[zoomedStartY:(zoomDY + zoomedStartY):, zoomedStartX:(zoomDX + zoomedStartX):, ::]
+        curFrame[zoomedPosY:(zoomDY + zoomedPosY):, zoomedPosX:(zoomDX + zoomedPosX):, ::] = zoomView.view(zoomedStartX, zoomedStartY, zoomDX, zoomDY)
         cv2.rectangle(curFrame, (zoomedPosX, zoomedPosY), (zoomedPosX + zoomDX, zoomedPosY + zoomDY), [255, 0, 0], thickness=3, lineType=cv2.LINE_AA)
         cv2.circle(curFrame, (zoomedPosX + zoomedRX - zShiftX, zoomedPosY + zoomedRY - zShiftY), 5, [255, 255, 255], thickness=3, lineType=cv2.LINE_AA)
         
         # Draw video frame
-        if not resizedVideoFrame is None:
-            curFrame[videoWindowPos[1]:(videoWindowPos[1] + videoSize[1]):, videoWindowPos[0]:(videoWindowPos[0] + videoSize[0]):, ::] = resizedVideoFrame
+        if not video.frame is None:
+            curFrame[videoWindowPos[1]:(videoWindowPos[1] + videoSize[1]):, videoWindowPos[0]:(videoWindowPos[0] + videoSize[0]):, ::] = video.frame
         
         cv2.imshow('frame',curFrame)
         
@@ -268,34 +489,32 @@ if __name__ == '__main__':
                 ind -= 1
         elif key & 0xFF == KEY_VIDEO_NEXT_FRAME:
             if isPausedVideo and (not isFinishedVideo):
-                ret, videoFrame = cap.read()
-                isFinishedVideo = not ret
-                if not isFinishedVideo:
-                    resizedVideoFrame = cv2.resize(videoFrame, videoSize, interpolation=cv2.INTER_AREA)
-                    videoFrameInd += 1
+                isFinishedVideo = not video.step()
         elif key & 0xFF == KEY_VIDEO_SKIP_N_FRAMES:
             for i in range(frames2skipN):
                 if isPausedVideo and (not isFinishedVideo):
-                    ret, videoFrame = cap.read()
-                    isFinishedVideo = not ret
-                    videoFrameInd += 1
-            if not isFinishedVideo:
-                resizedVideoFrame = cv2.resize(videoFrame, videoSize, interpolation=cv2.INTER_AREA)
+                    isFinishedVideo = not video.step()
+        elif key & 0xFF == KEY_VIDEO_PREV_FRAME:
+            if isPausedVideo and video.step(-1):
+                isFinishedVideo = False
+        elif key & 0xFF == KEY_VIDEO_BACK_N_FRAMES:
+            if isPausedVideo and video.seek(max(video.index - frames2skipN, 0)):
+                isFinishedVideo = False
         elif key & 0xFF == KEY_SAVE:
             print('Syncing...')
             trackTime = row['time']
-            videoTime = pd.to_datetime(videoStartTime + int(cap.get(cv2.CAP_PROP_POS_MSEC)/1000))
+            videoTime = pd.to_datetime(videoStartTime + int(video.posMS/1000))
             print('Track time:', trackTime)
             print('Video time:', videoTime)
 
             #diffTime = trackTime - videoTime
             diffTime = videoTime - trackTime
-            diffMS = int(cap.get(cv2.CAP_PROP_POS_MSEC) % 1000)
+            diffMS = int(video.posMS % 1000)
             
             print('Current time diff:', diffTime, '+', diffMS, "MS")
             print('Saved   time diff:', diffTime)
             print('Corrected video time:', videoTime + diffTime)
-            print('Video frame index:', videoFrameInd)
+            print('Video frame index:', video.index)
             print('Track point index:', ind)
             
             try:
@@ -305,6 +524,6 @@ if __name__ == '__main__':
             except:
                 print('Error saving ' + offsetFileName)
                 
-    cap.release()
+    video.release()
     cv2.destroyAllWindows()
     print('Done.')
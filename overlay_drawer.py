@@ -24,30 +24,24 @@ Prerequisites: pillow, py-opencv, numpy, pandas
 '''
 
 import strava_gpx as strava
+import track_cache
+import video_io
 import pandas as pd
 import numpy as np
 import cv2
-import PIL
 import os
 import json
+import shutil
+import tempfile
+import multiprocessing
 from widgets import Speedometer, Map, HeartRate
+from render import renderFrame, RenderPool, OverlayCanvas, mergeStats
+from profiling import StageTimer, Progress, NULL_TIMER
 
 ##########################################################################
 def decodeFourcc(cc):
     return ''.join([chr((int(cc) >> 8 * i) & 0xff) for i in range(4)]).upper()
 ##########################################################################
-def pure_pil_alpha_to_color(image, color=(255, 255, 255)):
-    '''Alpha composite an RGBA Image with a specified color.
-    Source: http://stackoverflow.com/a/9459208/284318
-    Keyword Arguments:
-    image -- PIL RGBA Image object
-    color -- Tuple r, g, b (default 255, 255, 255)
-    '''
-    image.load()  # needed for split()
-    background = PIL.Image.new('RGB', image.size, color)
-    background.paste(image, mask=image.split()[3])  # 3 is the alpha channel
-    return background
-##########################################################################
 def readOffsets(finename):
     try:
         with open(finename, 'r') as f:
@@ -63,6 +57,353 @@ def readOffsets(finename):
 def timeSec(hours, minutes, seconds):
     return int(seconds + 60*minutes + 3600*hours)
 ##########################################################################
+def drawOverlayOnly(widgets, timeline, timingStart, timingEnd, frameSize, outSize, out, timer=NULL_TIMER, progressInterval=2.0):
+    '''
+    Renders [widgets] onto a transparent BGRA canvas of [frameSize] for
+    every timeline frame within [timingStart, timingEnd) seconds and writes
+    them to [out]. No source video decoding involved. Returns the number
+    of frames written.
+    '''
+    canvas = OverlayCanvas(frameSize[0], frameSize[1])
+    offs = timeline.offsetsMS
+    inRange = np.nonzero((offs >= timingStart*1000) & (offs < timingEnd*1000))[0]
+    progress = Progress(len(inRange), progressInterval)
+    for n, i in enumerate(inRange):
+        t = timer.tick()
+        rec = timeline.record(i)
+        t = timer.lap('lookup', t)
+        frame = canvas.render(widgets, rec)
+        t = timer.lap('render', t)
+        if not outSize is None:
+            frame = cv2.resize(frame, outSize, interpolation=cv2.INTER_AREA)
+            t = timer.lap('resize', t)
+        out.write(frame)
+        timer.lap('write', t)
+        progress.update(n + 1, 'timing %d s' % int(offs[i]/1000))
+    return len(inRange)
+##########################################################################
+def showPreview(frame):
+    '''
+    Shows [frame] in the preview window. Returns False once 'q' is pressed.
+    Needs an OpenCV build with GUI support, so main process only.
+    '''
+    cv2.imshow('Preview', frame)
+    return not (cv2.waitKey(1) & 0xFF == ord('q'))
+##########################################################################
+def renderRange(cap, out, widgets, timeline, diffTimeMS, startMS, endMS, pool=None, outSize=None, verbose=True, timer=NULL_TIMER, progressInterval=2.0, preview=False, counter=None):
+    '''
+    Decodes [cap] and writes every frame whose offset-corrected time is
+    within [startMS, endMS) to [out] with the [widgets] drawn over it.
+    Stage times go to [timer], progress is printed every [progressInterval]
+    seconds if [verbose]. With [preview] written frames are also shown
+    (see showPreview). Every written frame also increments the shared
+    [counter] (multiprocessing.Value) if given. Returns the number of
+    frames written.
+    '''
+    offs = timeline.offsetsMS
+    progress = Progress(int(((offs >= startMS) & (offs < endMS)).sum()), progressInterval) if verbose else None
+    written = 0
+
+    while(cap.isOpened()):
+        t = timer.tick()
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        timingCurMS = cap.get(cv2.CAP_PROP_POS_MSEC) - diffTimeMS
+        t = timer.lap('decode', t)
+
+        if timingCurMS < startMS:
+            if verbose:
+                progress.message('Skipping to start... %d of %d s' % (int(timingCurMS/1000), int(startMS/1000)))
+            continue
+        elif timingCurMS >= endMS:
+            break
+
+        curRec = timeline.recordForOffset(timingCurMS)
+        t = timer.lap('lookup', t)
+
+        if pool is None:
+            frame = renderFrame(frame, widgets, curRec, outSize, timer)
+            t = timer.tick()
+            out.write(frame)
+            timer.lap('write', t)
+            ready = [frame]
+        else:
+            # Waiting for the workers included
+            ready = pool.submit(frame, curRec)
+            t = timer.lap('render', t)
+            for f in ready:
+                out.write(f)
+            timer.lap('write', t)
+        written += 1
+        if not counter is None:
+            with counter.get_lock():
+                counter.value += 1
+
+        if verbose:
+            progress.update(written, 'timing %d s' % int(timingCurMS/1000))
+
+        if preview and len(ready) > 0 and not showPreview(ready[-1]):
+            break
+
+    if not pool is None:
+        t = timer.tick()
+        for f in pool.finish():
+            out.write(f)
+        timer.lap('write', t)
+    return written
+##########################################################################
+def segmentBounds(timeline, timingStart, timingEnd, segments):
+    '''
+    Splits the clip range into at most [segments] (startMS, endMS) parts
+    holding equal numbers of timeline frames. Inner boundaries lie halfway
+    between two neighbouring frames, so every decoded frame falls into
+    exactly one part even if its timestamp jitters a bit.
+    '''
+    offs = timeline.offsetsMS
+    offs = offs[(offs >= timingStart*1000) & (offs < timingEnd*1000)]
+    segments = max(1, min(segments, len(offs)))
+
+    cuts = [int(round(i*len(offs)/segments)) for i in range(1, segments)]
+    inner = [(offs[c - 1] + offs[c])/2.0 for c in cuts]
+    edges = [timingStart*1000] + inner + [timingEnd*1000]
+    return list(zip(edges[:-1], edges[1:]))
+##########################################################################
+_segmentCounter = None
+
+def _initSegmentWorker(counter):
+    global _segmentCounter
+    _segmentCounter = counter
+
+def renderSegment(seg):
+    '''
+    Renders one segment in a worker process. [seg] is a dict with
+    everything needed: the source, its own copy of the prepared widgets,
+    the timeline, the time range and the output writer parameters.
+    Written frames are counted in the pool's shared counter, for the
+    parent's progress line. Returns the number of frames written, the
+    stage timer samples and the widget stats.
+    '''
+    timer = StageTimer() if seg['profile'] else NULL_TIMER
+    cap = cv2.VideoCapture(seg['videoFileName'])
+    if not seg['seekPrerollMS'] is None:
+        video_io.seekNear(cap, seg['startMS'] + seg['diffTimeMS'], seg['seekPrerollMS'])
+
+    out = video_io.makeVideoWriter(
+            seg['writerBackend'], seg['segFile'], seg['size'], seg['fps'], seg['encoding'],
+            seg['ffmpegPath'], seg['ffmpegArgs']
+            )
+    try:
+        written = renderRange(
+                cap, out, seg['widgets'], seg['timeline'], seg['diffTimeMS'],
+                seg['startMS'], seg['endMS'], outSize=seg['outSize'], verbose=False, timer=timer,
+                counter=_segmentCounter
+                )
+    finally:
+        cap.release()
+        out.release()
+    print('Segment %d: %d frames from %.3f s' % (seg['index'], written, seg['startMS']/1000.0))
+    return written, timer.samples, [w.stats() for w in seg['widgets']]
+##########################################################################
+def renderSegmented(segments, segmentParams, timeline, timingStart, timingEnd, outFile, ffmpegPath, audioFrom=None, audioStartMS=0, audioCodec='aac', timer=NULL_TIMER, progressInterval=2.0):
+    '''
+    Renders the clip as [segments] parts in parallel processes (each one
+    decoding its own part of the source) and joins them into [outFile]
+    without re-encoding. [segmentParams] is the renderSegment() dict
+    without the per-segment keys. Progress of all the parts together is
+    printed every [progressInterval] seconds. Stage times of all the parts
+    are added to [timer]. Returns the number of frames written and the
+    widget stats added up over the parts.
+    '''
+    bounds = segmentBounds(timeline, timingStart, timingEnd, segments)
+    segDir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(os.path.abspath(outFile)))
+    ext = os.path.splitext(outFile)[1]
+
+    segs = []
+    for i, (startMS, endMS) in enumerate(bounds):
+        seg = dict(segmentParams)
+        seg.update(index=i, startMS=startMS, endMS=endMS, timeline=timeline, profile=timer.enabled,
+                   segFile=os.path.join(segDir, 'seg%04d%s' % (i, ext)))
+        segs.append(seg)
+
+    offs = timeline.offsetsMS
+    progress = Progress(int(((offs >= bounds[0][0]) & (offs < bounds[-1][1])).sum()), progressInterval)
+    counter = multiprocessing.Value('l', 0)
+    try:
+        with multiprocessing.Pool(processes=len(segs), initializer=_initSegmentWorker, initargs=(counter,)) as pool:
+            pending = pool.map_async(renderSegment, segs, chunksize=1)
+            while not pending.ready():
+                pending.wait(progressInterval)
+                progress.update(counter.value)
+            results = pending.get()
+        segFiles = [s['segFile'] for s, (n, _, _) in zip(segs, results) if n > 0]
+        t = timer.tick()
+        video_io.concatSegments(segFiles, outFile, ffmpegPath, audioFrom, audioStartMS, audioCodec)
+        timer.lap('concat', t)
+    finally:
+        shutil.rmtree(segDir, ignore_errors=True)
+    for _, samples, _ in results:
+        timer.merge(samples)
+    widgetStats = [mergeStats(st) for st in zip(*[stats for _, _, stats in results])]
+    return sum(n for n, _, _ in results), widgetStats
+##########################################################################
+def renderClip(videoFileName, videoStartTime, timingStart, timingEnd, trackFileName, offsetFileName, outFile, widgets,
+               seekPrerollMS=1000, trackCacheDir='.track_cache', speedSmoothing='window', speedSmoothingRadius=1, writerBackend='ffmpeg', encoding='h264', ffmpegPath='ffmpeg',
+               ffmpegCodec='libx264', ffmpegPreset='medium', ffmpegCRF=18, ffmpegThreads=0, ffmpegPixFmt='yuv420p',
+               copyAudio=True, audioCodec='aac', outputMode='video', overlayFormat='png', overlayFile='overlay',
+               overlaySize=None, overlayFPS=None, forcedWidth=None, forcedHeight=None,
+               renderWorkers=0, renderQueueDepth=8, renderSegments=1, progressInterval=2.0,
+               profile=False, profileReport='profile.json', preview=False, df=None):
+    '''
+    Renders one clip. The parameters are the ones of the Settings section
+    below. [df] is an already parsed track to use instead of reading
+    [trackFileName]. Returns a dict with the number of frames written.
+    '''
+    timer = StageTimer() if profile else NULL_TIMER
+
+    # Clear output file if exists
+    if outputMode == 'video' and os.path.exists(outFile):
+        os.remove(outFile) # Will rise exception if it's a directory
+
+    # Read offsets
+    diffTime, diffTimeMS = readOffsets(offsetFileName)
+
+    # Read GPX, unless the caller already did
+    t = timer.tick()
+    if df is None:
+        df = track_cache.readGPXCached(trackFileName, cacheDir=trackCacheDir, interpolateToSeconds=False,
+                                       smoothing=speedSmoothing, smoothingRadius=speedSmoothingRadius)
+    timer.lap('readGPX', t)
+    
+    # Prepare widgets
+    for w in widgets:
+        t = timer.tick()
+        w.prepare(df)
+        timer.lap('prepare.' + type(w).__name__, t)
+        if w.stats():
+            print(type(w).__name__, w.stats())
+    
+    # Open video, unless it's an overlay with its own size and rate
+    if outputMode == 'overlay' and not overlaySize is None and not overlayFPS is None:
+        cap = None
+        width, height = overlaySize
+        outFPS = overlayFPS
+    else:
+        cap = cv2.VideoCapture(videoFileName)
+        if not cap.isOpened():
+            raise IOError('Can\'t open ' + videoFileName)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        expectedFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        outFPS = cap.get(cv2.CAP_PROP_FPS)
+        
+        print('File: ', videoFileName)
+        print(
+            decodeFourcc(cap.get(cv2.CAP_PROP_FOURCC)), '@', '%.0f FPS'%cap.get(cv2.CAP_PROP_FPS),
+            ':', width, 'x', height
+        )
+        print('Frames: ', expectedFrames)
+        
+        if outputMode == 'overlay':
+            if not overlaySize is None:
+                width, height = overlaySize
+            if not overlayFPS is None:
+                outFPS = overlayFPS
+            # The header is all we need
+            cap.release()
+    frameSize = (width, height)
+    
+    # Check resizing and form the output writer    
+    isResizing = (not forcedWidth is None and forcedWidth > 0) and (not forcedHeight is None and forcedHeight > 0)
+    if isResizing:
+        width = int(forcedWidth)&~1
+        height = int(forcedHeight)&~1
+    
+    videoTime = pd.to_datetime(videoStartTime) - diffTime
+    
+    # Per-frame telemetry, interpolated for the whole range at once
+    timeline = strava.makeFrameTimeline(df, videoTime, outFPS, timingStart, timingEnd, diffTimeMS)
+    if timeline.outOfRangeCount > 0:
+        print('Warning: %d of %d frames are out of the track time range'%(timeline.outOfRangeCount, len(timeline)))
+    
+    # Widgets precompute their per-frame state, before they're copied to
+    # the render workers or segments
+    for w in widgets:
+        t = timer.tick()
+        w.prepareTimeline(timeline)
+        timer.lap('prepareTimeline.' + type(w).__name__, t)
+    
+    # Source time of the first rendered frame, to cut the audio from
+    inRange = timeline.offsetsMS[timeline.offsetsMS >= timingStart*1000]
+    audioStartMS = (inRange[0] if len(inRange) > 0 else timingStart*1000) + diffTimeMS
+    audioFrom = videoFileName if copyAudio else None
+    ffmpegArgs = video_io.ffmpegVideoArgs(ffmpegCodec, ffmpegPreset, ffmpegCRF, ffmpegThreads, ffmpegPixFmt)
+    outSize = (width, height) if isResizing else None
+    
+    isSegmented = outputMode == 'video' and renderSegments > 1
+    if isSegmented and not video_io.isFfmpegAvailable(ffmpegPath):
+        print('Warning: ffmpeg not found, rendering in a single segment')
+        isSegmented = False
+    
+    out = None
+    if outputMode == 'overlay':
+        out = video_io.makeOverlayWriter(overlayFormat, overlayFile, (width, height), outFPS, ffmpegPath)
+        written = drawOverlayOnly(widgets, timeline, timingStart, timingEnd, frameSize, outSize, out, timer, progressInterval)
+        widgetStats = [w.stats() for w in widgets]
+    elif isSegmented:
+        cap.release()
+        segmentParams = dict(
+                videoFileName=videoFileName, seekPrerollMS=seekPrerollMS, diffTimeMS=diffTimeMS,
+                widgets=widgets, outSize=outSize,
+                writerBackend=writerBackend, size=(width, height), fps=outFPS, encoding=encoding,
+                ffmpegPath=ffmpegPath, ffmpegArgs=ffmpegArgs
+                )
+        written, widgetStats = renderSegmented(
+                renderSegments, segmentParams, timeline, timingStart, timingEnd, outFile, ffmpegPath,
+                audioFrom=audioFrom, audioStartMS=audioStartMS, audioCodec=audioCodec, timer=timer,
+                progressInterval=progressInterval
+                )
+        print('Frames written: ', written)
+    else:
+        out = video_io.makeVideoWriter(
+                writerBackend, outFile, (width, height), outFPS, encoding, ffmpegPath, ffmpegArgs,
+                audioFrom=audioFrom, audioStartMS=audioStartMS, audioCodec=audioCodec
+                )
+        pool = RenderPool(widgets, renderWorkers, renderQueueDepth, outSize) if renderWorkers > 0 else None
+        
+        # Jump close to the clip start instead of decoding all the skipped frames
+        if not seekPrerollMS is None:
+            video_io.seekNear(cap, timingStart*1000 + diffTimeMS, seekPrerollMS)
+        
+        written = renderRange(
+                cap, out, widgets, timeline, diffTimeMS, timingStart*1000, timingEnd*1000, pool, outSize,
+                timer=timer, progressInterval=progressInterval, preview=preview
+                )
+        # Rendered by the workers' copies of the widgets with a pool
+        widgetStats = [w.stats() for w in widgets] if pool is None else pool.widgetStats()
+        
+    for w, st in zip(widgets, widgetStats):
+        if st:
+            print(type(w).__name__, st)
+    
+    if not cap is None:
+        cap.release()
+    if not out is None:
+        out.release()
+    if preview:
+        cv2.destroyAllWindows()
+    
+    if profile:
+        timer.printSummary()
+        timer.writeReport(profileReport, frames=written, videoFileName=videoFileName, outputMode=outputMode,
+                          renderWorkers=renderWorkers, renderSegments=renderSegments,
+                          widgets=[dict(st, widget=type(w).__name__) for w, st in zip(widgets, widgetStats)])
+        print('Profile report written to', profileReport)
+    
+    print('Done.')
+    return {'frames': written}
+##########################################################################
 if __name__ == '__main__':
     # ------- Settings -------
     # Input video file name. No strict requirements as long as OpenCV can read it
@@ -74,17 +415,70 @@ if __name__ == '__main__':
     # Input video start and stop moments (in seconds from start)    
     timingStart = timeSec(hours=0, minutes=13, seconds=11)
     timingEnd   = timeSec(hours=0, minutes=14, seconds=35)
+
+    # Decoding starts this far before timingStart (ms) after seeking to it.
+    # Set to None to decode everything from the file start
+    seekPrerollMS = 1000
     
     # Input track file name. Should be track saved from Strava via "Export GPX"
     # function (assuming it works the same way as at November 2019)
     trackFileName = 'downhill.gpx'
+
+    # Parsed track cache directory. Set to None to parse the GPX on every run
+    trackCacheDir = '.track_cache'
+    
+    # Speed (vel_filt, the speedometer value) smoothing. 'window' is the
+    # distance over time between the points speedSmoothingRadius before and
+    # after. 'median' and 'savgol' (Savitzky-Golay) work on windows of
+    # 2*speedSmoothingRadius + 1 points (at least 5 for 'savgol', fewer
+    # can't smooth), 'kalman' is a Kalman smoother with a time constant of
+    # speedSmoothingRadius seconds
+    speedSmoothing = 'window'
+    speedSmoothingRadius = 1
     
     # Input timing offsets file. The one saved with moment_track.py
     offsetFileName = 'offset.json'
 
-    # Output video vile parameters. Compatibility depends on local OpenCV version
+    # Output video vile parameters
     outFile = 'out.mp4'
+    
+    # Output writer backend. 'ffmpeg' streams frames to a local ffmpeg
+    # (falls back to 'opencv' if ffmpeg isn't found), 'opencv' uses
+    # cv2.VideoWriter with the [encoding] fourcc. OpenCV codec
+    # compatibility depends on the local OpenCV build
+    writerBackend = 'ffmpeg'
     encoding = 'h264'
+    ffmpegPath = 'ffmpeg'
+    
+    # ffmpeg encoder settings. Preset and CRF (lower is better quality) are
+    # used by libx264/libx265 only. 0 threads lets the encoder decide
+    ffmpegCodec = 'libx264'
+    ffmpegPreset = 'medium'
+    ffmpegCRF = 18
+    ffmpegThreads = 0
+    ffmpegPixFmt = 'yuv420p'
+    
+    # Copy the source audio of the rendered range (ffmpeg backend only).
+    # 'copy' keeps the audio codec as is if the output container allows
+    copyAudio = True
+    audioCodec = 'aac'
+    
+    # Output mode. 'video' draws the widgets over the decoded source video.
+    # 'overlay' renders the widgets only, onto a transparent canvas of the
+    # source size and frame rate, for compositing in an editor. The source
+    # video is not decoded in this mode, only its header is read
+    outputMode = 'video'
+    
+    # Overlay mode output. 'png' writes an image sequence into the
+    # overlayFile directory. 'prores4444', 'qtrle' and 'png_mov' encode an
+    # alpha-capable .mov with a local ffmpeg (see ffmpegPath)
+    overlayFormat = 'png'
+    overlayFile = 'overlay'
+    
+    # Overlay mode frame size (w, h) and rate. None takes them from the
+    # source video header; with both set the source isn't opened at all
+    overlaySize = None
+    overlayFPS = None
     
     # Forced output size. Not used if at least one is negative or None
     forcedWidth = None
@@ -97,102 +491,51 @@ if __name__ == '__main__':
             Map.IMPL02(pos=(1100, 50), size=(800, 800)),
             HeartRate.IMPL01(pos=(1600, 900), scale=1.0)
             ]
-    # ------- End of settings -------
     
-    # Clear output file if exists
-    if os.path.exists(outFile):
-        os.remove(outFile) # Will rise exception if it's a directory
-
-    # Read offsets
-    diffTime, diffTimeMS = readOffsets(offsetFileName)
+    # Widget compositing. 'paste' looks exactly like the original renderer,
+    # including a light haze on semi-transparent widget parts (e.g. the map
+    # outline). 'over' blends them as plain alpha without the haze, which
+    # changes the look of the widgets
+    widgetCompositing = 'paste'
 
-    # Read GPX
-    df = strava.readGPX(trackFileName, interpolateToSeconds=False)
+    # Parallel rendering. Number of worker processes (0 means rendering in
+    # the main process) and max number of frames in flight. Each frame in
+    # flight holds a couple of full-size copies, so keep the depth moderate
+    # on 4K input
+    renderWorkers = 0
+    renderQueueDepth = 8
     
-    # Prepare widgets
-    for w in widgets:
-        w.prepare(df)
+    # Segment rendering. Splits the range into this many parts rendered by
+    # separate processes, each decoding its own part of the source, and
+    # joins them without re-encoding. Needs ffmpeg for the join. Per-frame
+    # workers (renderWorkers) aren't used within segments
+    renderSegments = 1
     
-    # Open video
-    cap = cv2.VideoCapture(videoFileName)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    expectedFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    outFPS = cap.get(cv2.CAP_PROP_FPS)
+    # Progress line interval, seconds
+    progressInterval = 2.0
     
-    print('File: ', videoFileName)
-    print(
-        decodeFourcc(cap.get(cv2.CAP_PROP_FOURCC)), '@', '%.0f FPS'%cap.get(cv2.CAP_PROP_FPS),
-        ':', width, 'x', height
-    )
-    print('Frames: ', expectedFrames)
+    # Per-stage and per-widget timings. Printed and saved to profileReport
+    # (JSON) at the end. Widget times aren't collected from renderWorkers
+    profile = False
+    profileReport = 'profile.json'
     
-    # Check resizing and form the output writer    
-    isResizing = (not forcedWidth is None and forcedWidth > 0) and (not forcedHeight is None and forcedHeight > 0)
-    if isResizing:
-        width = int(forcedWidth)&~1
-        height = int(forcedHeight)&~1
-    
-    fourcc = cv2.VideoWriter_fourcc(*encoding)
-    out = cv2.VideoWriter(outFile, fourcc, outFPS, (width, height))
-    
-    timingPrev = 0
-
-    videoTime = pd.to_datetime(videoStartTime) - diffTime
-    
-    #  Percentage scaling
-    timingScale = 100.0/(timingEnd - timingStart)
+    # Show the rendered frames in a window while rendering, 'q' stops.
+    # Needs an OpenCV build with GUI support (not the headless one). Not
+    # used in overlay mode and with renderSegments
+    preview = False
+    # ------- End of settings -------
     
-    while(cap.isOpened()):
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        timingCurMS = cap.get(cv2.CAP_PROP_POS_MSEC) - diffTimeMS
-        timingCur = int(timingCurMS/1000)
-        
-        if not timingPrev == timingCur:
-            percentStr = 'skipping to start...'
-            if timingCur >= timingStart:
-                percentage = int((timingCur - timingStart)*timingScale)
-                percentStr = '%d%% complete'%(percentage)
-            else:
-                percentage = int((timingCur/timingStart)*100) if timingStart > 0 else 100
-                percentStr = 'skipping to start... %d%%'%(percentage)
-            print('Cur timing: %d of %d to %d (%s)'% (timingCur, timingStart , timingEnd, percentStr))
-            timingPrev = timingCur
-            
-        if timingCur < timingStart:
-            continue
-        elif timingCur >= timingEnd:
-            break
-        
-        curRec = strava.getRecordForTimeAndOffset(df, videoTime, timingCurMS)
-        
-        # ocv to pil
-        frame = cv2.cvtColor(frame,cv2.COLOR_BGR2RGB)
-        pil_im = PIL.Image.fromarray(frame).convert('RGBA')
-        
-        # Draw widgets
-        for w in widgets:
-            w.draw(pil_im, curRec)
-        
-        # pil to ocv
-        if isResizing:
-            frame = cv2.resize(np.array(pure_pil_alpha_to_color(pil_im))[:, :, ::-1], (width, height), interpolation=cv2.INTER_AREA)
-        else:
-            frame = np.array(pure_pil_alpha_to_color(pil_im))[:, :, ::-1]
-            #frame = np.array(pure_pil_alpha_to_color(pil_im))[:, :, ::-1].copy()
-
-        # Write frame        
-        out.write(frame)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-        
-        
-    cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+    for w in widgets:
+        w.compositing = widgetCompositing
     
-    print('Done.')
+    renderClip(
+            videoFileName, videoStartTime, timingStart, timingEnd, trackFileName, offsetFileName, outFile, widgets,
+            seekPrerollMS=seekPrerollMS, trackCacheDir=trackCacheDir, speedSmoothing=speedSmoothing,
+            speedSmoothingRadius=speedSmoothingRadius, writerBackend=writerBackend, encoding=encoding,
+            ffmpegPath=ffmpegPath, ffmpegCodec=ffmpegCodec, ffmpegPreset=ffmpegPreset, ffmpegCRF=ffmpegCRF,
+            ffmpegThreads=ffmpegThreads, ffmpegPixFmt=ffmpegPixFmt, copyAudio=copyAudio, audioCodec=audioCodec,
+            outputMode=outputMode, overlayFormat=overlayFormat, overlayFile=overlayFile, overlaySize=overlaySize,
+            overlayFPS=overlayFPS, forcedWidth=forcedWidth, forcedHeight=forcedHeight, renderWorkers=renderWorkers,
+            renderQueueDepth=renderQueueDepth, renderSegments=renderSegments, progressInterval=progressInterval,
+            profile=profile, profileReport=profileReport, preview=preview
+            )
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+'''
+                  RUNTIME INSTRUMENTATION
+Not intended for a standalone distribution. Just a helpers collection here.
+
+StageTimer collects per-stage durations of the render loop:
+
+    t = timer.tick()
+    ret, frame = cap.read()
+    t = timer.lap('decode', t)
+    ...
+    t = timer.lap('write', t)
+
+A disabled timer (NULL_TIMER is one) does nothing but return 0 from both
+calls, so the instrumented code costs next to nothing when it's off.
+Progress prints a rate-limited frames/sec and ETA line.
+'''
+
+import numpy as np
+import json
+import time
+
+##########################################################################
+class StageTimer:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.samples = {}
+        self.started = time.perf_counter()
+# ------------------------------------------------------------------------
+    def tick(self):
+        return time.perf_counter() if self.enabled else 0.0
+# ------------------------------------------------------------------------
+    def lap(self, name, since):
+        '''
+        Adds the time passed [since] a tick() to stage [name]. Returns the
+        current time, so consecutive stages can be chained.
+        '''
+        if not self.enabled:
+            return 0.0
+        t = time.perf_counter()
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = []
+        samples.append(t - since)
+        return t
+# ------------------------------------------------------------------------
+    def merge(self, samples):
+        '''
+        Adds the [samples] dict of another timer (e.g. returned by a worker
+        process).
+        '''
+        for name, s in samples.items():
+            self.samples.setdefault(name, []).extend(s)
+# ------------------------------------------------------------------------
+    def summary(self):
+        '''
+        Per-stage count, total and mean plus percentiles, in seconds.
+        '''
+        result = {}
+        for name, s in self.samples.items():
+            a = np.asarray(s)
+            p50, p90, p99 = np.percentile(a, [50, 90, 99])
+            result[name] = {
+                'count': len(a), 'total': float(a.sum()), 'mean': float(a.mean()),
+                'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(a.max())
+                }
+        return result
+# ------------------------------------------------------------------------
+    def printSummary(self):
+        summary = self.summary()
+        total = sum(s['total'] for s in summary.values()) or 1.0
+        print('%-28s %8s %10s %9s %9s %9s %7s' % ('stage', 'count', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'share'))
+        for name, s in sorted(summary.items(), key=lambda kv: -kv[1]['total']):
+            print('%-28s %8d %10.3f %9.3f %9.3f %9.3f %6.1f%%' % (
+                    name, s['count'], s['total'], s['p50']*1000, s['p90']*1000, s['p99']*1000, 100*s['total']/total))
+# ------------------------------------------------------------------------
+    def writeReport(self, filename, **extra):
+        '''
+        Dumps the summary and the wall clock time along with any [extra]
+        values (frame count etc) to a JSON file.
+        '''
+        report = dict(extra)
+        report['wallSeconds'] = time.perf_counter() - self.started
+        report['stages'] = self.summary()
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+
+NULL_TIMER = StageTimer(enabled=False)
+##########################################################################
+class Progress:
+    '''
+    Frames done out of [total] with the current frames/sec and ETA, printed
+    at most once in [interval] seconds (and once at the very end). The
+    clock starts at the first frame reported, so seeking and skipping
+    before it don't stretch the early ETAs.
+    '''
+    def __init__(self, total, interval=2.0):
+        self.total = total
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.lastTime = self.started
+        self.lastDone = 0
+        self.firstDone = None
+        self.finished = False
+# ------------------------------------------------------------------------
+    def due(self):
+        return time.perf_counter() - self.lastTime >= self.interval
+# ------------------------------------------------------------------------
+    def update(self, done, note=''):
+        now = time.perf_counter()
+        if self.firstDone is None:
+            if done <= 0:
+                return
+            self.started = self.lastTime = now
+            self.firstDone = self.lastDone = done
+        if self.finished or (now - self.lastTime < self.interval and done < self.total):
+            return
+        fps = (done - self.lastDone)/max(now - self.lastTime, 1e-6)
+        avgFPS = (done - self.firstDone)/max(now - self.started, 1e-6)
+        eta = (self.total - done)/avgFPS if avgFPS > 0 else 0
+        percent = int(100*done/self.total) if self.total > 0 else 100
+        print('Frames %d of %d (%d%%), %.1f fps, ETA %s%s' % (
+                done, self.total, percent, fps, formatSeconds(eta), ' | ' + note if note else ''))
+        self.lastTime = now
+        self.lastDone = done
+        self.finished = done >= self.total
+# ------------------------------------------------------------------------
+    def message(self, text):
+        '''
+        Rate-limited free text, for the stages before the first frame.
+        '''
+        if self.due():
+            print(text)
+            self.lastTime = time.perf_counter()
+##########################################################################
+def formatSeconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds//3600, (seconds//60) % 60, seconds % 60)
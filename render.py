@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+'''
+                  FRAME RENDERING
+Not intended for a standalone distribution. Just a helpers collection here.
+
+renderFrame() draws the widgets over a single decoded frame. RenderPool does
+the same in a pool of worker processes, each holding its own copy of the
+prepared widgets list, and hands rendered frames back in submission order.
+
+Only the regions covered by widgets go through PIL: each one is pasted into
+and flattened onto white exactly like the whole frame used to be, so the
+result is the same pixel for pixel.
+'''
+
+import numpy as np
+import cv2
+import PIL
+import multiprocessing
+import os
+from collections import deque
+from profiling import NULL_TIMER
+
+##########################################################################
+def pure_pil_alpha_to_color(image, color=(255, 255, 255)):
+    '''Alpha composite an RGBA Image with a specified color.
+    Source: http://stackoverflow.com/a/9459208/284318
+    Keyword Arguments:
+    image -- PIL RGBA Image object
+    color -- Tuple r, g, b (default 255, 255, 255)
+    '''
+    image.load()  # needed for split()
+    background = PIL.Image.new('RGB', image.size, color)
+    background.paste(image, mask=image.split()[3])  # 3 is the alpha channel
+    return background
+##########################################################################
+def widgetGroups(widgets, size):
+    '''
+    Splits [widgets] into groups drawn within one region of a frame of
+    [size]: widgets whose boxes overlap share a region, so the overlap is
+    composited in one go as on the full frame. Widgets without a bbox cover
+    the whole frame. Returns a list of ((x0, y0, x1, y1), widgets), each
+    group keeping the drawing order.
+    '''
+    groups = []
+    for ind, w in enumerate(widgets):
+        box = w.bbox()
+        if box is None:
+            rect = (0, 0, size[0], size[1])
+        else:
+            rect = (max(box[0], 0), max(box[1], 0), min(box[0] + box[2], size[0]), min(box[1] + box[3], size[1]))
+        if rect[2] <= rect[0] or rect[3] <= rect[1]:
+            continue
+        
+        members = [ind]
+        i = 0
+        while i < len(groups):
+            r, inds = groups[i]
+            if r[0] < rect[2] and rect[0] < r[2] and r[1] < rect[3] and rect[1] < r[3]:
+                rect = (min(r[0], rect[0]), min(r[1], rect[1]), max(r[2], rect[2]), max(r[3], rect[3]))
+                members += inds
+                del groups[i]
+                i = 0
+            else:
+                i += 1
+        groups.append((rect, members))
+    return [(rect, [widgets[i] for i in sorted(inds)]) for rect, inds in groups]
+##########################################################################
+def compositeOver(img, im, pos):
+    # alpha_composite() of RGBA [im] at [pos], clipped to [img]
+    x, y = int(pos[0]), int(pos[1])
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + im.size[0], img.size[0]), min(y + im.size[1], img.size[1])
+    if x1 <= x0 or y1 <= y0:
+        return
+    img.alpha_composite(im, (x0, y0), (x0 - x, y0 - y, x1 - x, y1 - y))
+##########################################################################
+def drawGroup(roi, origin, widgets, layers, record, timer=NULL_TIMER):
+    '''
+    Draws [widgets] with their [layers] (a list of cachedLayers() results,
+    None for full-frame drawing) onto the BGR [roi] in place, [origin]
+    being the roi's top-left corner in the frame. Timer stages: one
+    'paste.<Widget>' per widget and the roi conversions.
+    '''
+    t = timer.tick()
+    pil_im = PIL.Image.fromarray(cv2.cvtColor(roi, cv2.COLOR_BGR2RGBA))
+    t = timer.lap('convert.roiIn', t)
+    for w, wLayers in zip(widgets, layers):
+        if wLayers is None:
+            w.draw(pil_im, record)
+        else:
+            for source, pos, mask in wLayers:
+                pos = (int(pos[0]) - origin[0], int(pos[1]) - origin[1])
+                if w.compositing == 'over' and mask is source:
+                    compositeOver(pil_im, source, pos)
+                else:
+                    pil_im.paste(source, pos, mask)
+        t = timer.lap('paste.' + type(w).__name__, t)
+    roi[...] = cv2.cvtColor(np.asarray(pure_pil_alpha_to_color(pil_im)), cv2.COLOR_RGB2BGR)
+    timer.lap('convert.roiOut', t)
+##########################################################################
+class OverlayCanvas:
+    '''
+    Transparent BGRA canvas of the frame size for overlay-only rendering.
+    Each widget region is drawn over black and over white: what drawing
+    does to any frame is then black + (white - black)*frame/255, i.e. an
+    "over" with alpha 255 - (white - black) and colour black/alpha. So the
+    overlay composited in an editor looks the same as the rendered video.
+    The canvas is reused between frames: only the regions touched by the
+    previous frame are cleared, and nothing is redrawn at all if every
+    widget reused its previous layers.
+    '''
+    def __init__(self, width, height):
+        self.canvas = np.zeros((height, width, 4), dtype=np.uint8)
+        self.dirty = None
+# ------------------------------------------------------------------------
+    def render(self, widgets, record):
+        allLayers = [w.cachedLayers(record) for w in widgets]
+        if not self.dirty is None and all(w.layersReused for w in widgets):
+            return self.canvas
+        
+        for x0, y0, x1, y1 in (self.dirty or []):
+            self.canvas[y0:y1, x0:x1] = 0
+        self.dirty = []
+        
+        layersOf = dict(zip(map(id, widgets), allLayers))
+        for rect, group in widgetGroups(widgets, (self.canvas.shape[1], self.canvas.shape[0])):
+            x0, y0, x1, y1 = rect
+            layers = [layersOf[id(w)] for w in group]
+            black = np.zeros((y1 - y0, x1 - x0, 3), np.uint8)
+            white = np.full((y1 - y0, x1 - x0, 3), 255, np.uint8)
+            drawGroup(black, (x0, y0), group, layers, record)
+            drawGroup(white, (x0, y0), group, layers, record)
+            
+            alpha = 255 - (white.astype(np.int32) - black).mean(axis=2, keepdims=True)
+            bgr = black*255.0/np.maximum(alpha, 1)
+            roi = self.canvas[y0:y1, x0:x1]
+            roi[:, :, :3] = np.clip(bgr + 0.5, 0, 255).astype(np.uint8)
+            roi[:, :, 3:4] = np.clip(alpha + 0.5, 0, 255).astype(np.uint8)
+            self.dirty.append(rect)
+        return self.canvas
+##########################################################################
+def _drawFullFrame(frame, widget, record, timer=NULL_TIMER):
+    # Full-frame PIL round trip for widgets that don't report their bbox
+    t = timer.tick()
+    rgb = cv2.cvtColor(frame,cv2.COLOR_BGR2RGB)
+    pil_im = PIL.Image.fromarray(rgb).convert('RGBA')
+    t = timer.lap('convert.frameIn', t)
+    widget.draw(pil_im, record)
+    t = timer.lap('draw.' + type(widget).__name__, t)
+    frame = np.ascontiguousarray(np.array(pure_pil_alpha_to_color(pil_im))[:, :, ::-1])
+    timer.lap('convert.frameOut', t)
+    return frame
+##########################################################################
+def renderFrame(frame, widgets, record, outSize=None, timer=NULL_TIMER):
+    '''
+    Draws [widgets] with telemetry [record] over the BGR [frame] (modified
+    in place). Returns the BGR frame ready to be written, resized to
+    [outSize] if given. Per-widget times go to [timer]: building the
+    layers as 'layers.<Widget>', drawing them as 'paste.<Widget>'.
+    '''
+    layersOf = {}
+    for w in widgets:
+        t = timer.tick()
+        layersOf[id(w)] = w.cachedLayers(record)
+        timer.lap('layers.' + type(w).__name__, t)
+    for rect, group in widgetGroups(widgets, (frame.shape[1], frame.shape[0])):
+        x0, y0, x1, y1 = rect
+        drawGroup(frame[y0:y1, x0:x1], (x0, y0), group, [layersOf[id(w)] for w in group], record, timer)
+
+    if not outSize is None:
+        t = timer.tick()
+        frame = cv2.resize(frame, outSize, interpolation=cv2.INTER_AREA)
+        timer.lap('resize', t)
+    return frame
+##########################################################################
+def mergeStats(statsList):
+    '''
+    Adds up the stats() of copies of one widget, e.g. from several worker
+    processes. Hit rates are computed again from the added up counts.
+    '''
+    res = {}
+    for st in statsList:
+        for k, v in st.items():
+            res[k] = res.get(k, 0) + v
+    if 'spriteCacheMB' in res:
+        res['spriteCacheMB'] = round(res['spriteCacheMB'], 1)
+    if res.get('layerHits', 0) + res.get('layerMisses', 0) > 0:
+        res['layerHitRate'] = round(res['layerHits']/(res['layerHits'] + res['layerMisses']), 3)
+    return res
+##########################################################################
+_workerWidgets = None
+_workerOutSize = None
+
+def _initWorker(widgets, outSize):
+    global _workerWidgets, _workerOutSize
+    _workerWidgets = widgets
+    _workerOutSize = outSize
+
+def _renderInWorker(frame, record):
+    # The worker's widget stats so far go along with every frame
+    frame = renderFrame(frame, _workerWidgets, record, _workerOutSize)
+    return frame, os.getpid(), [w.stats() for w in _workerWidgets]
+##########################################################################
+class RenderPool:
+    '''
+    Renders frames in [workers] processes. At most [queueDepth] frames are
+    in flight at any moment, which bounds memory regardless of the frame
+    size: submit() blocks on the oldest frame once the queue is full.
+    Results always come out in submission order. widgetStats() adds up
+    the widget stats of all the workers.
+
+    Usage:
+        for f in pool.submit(frame, record): out.write(f)
+        ...
+        for f in pool.finish(): out.write(f)
+    '''
+    def __init__(self, widgets, workers, queueDepth, outSize=None):
+        self.queueDepth = max(1, queueDepth)
+        self.pending = deque()
+        self.workerStats = {}
+        self.pool = multiprocessing.Pool(processes=workers, initializer=_initWorker, initargs=(widgets, outSize))
+# ------------------------------------------------------------------------
+    def submit(self, frame, record):
+        self.pending.append(self.pool.apply_async(_renderInWorker, (frame, record)))
+        ready = []
+        while len(self.pending) >= self.queueDepth:
+            ready.append(self._next())
+        return ready
+# ------------------------------------------------------------------------
+    def finish(self):
+        while len(self.pending) > 0:
+            yield self._next()
+        self.close()
+# ------------------------------------------------------------------------
+    def widgetStats(self):
+        # Per widget, in the widgets list order
+        return [mergeStats(st) for st in zip(*self.workerStats.values())]
+# ------------------------------------------------------------------------
+    def _next(self):
+        try:
+            frame, pid, stats = self.pending.popleft().get()
+            self.workerStats[pid] = stats
+            return frame
+        except:
+            # Don't leave workers hanging on a failed frame
+            self.pool.terminate()
+            self.pool = None
+            self.pending.clear()
+            raise
+# ------------------------------------------------------------------------
+    def close(self):
+        if not self.pool is None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+# ------------------------------------------------------------------------
+    def __del__(self):
+        try:
+            if not self.pool is None:
+                self.pool.terminate()
+        except:
+            pass
@@ -8,122 +8,344 @@ Not intended for a standalone distribution. Just a helpers collection here.
 import pandas as pd
 import numpy as np
 import math
+import warnings
 
 import xml.etree.ElementTree as etree
 ##########################################################################
 # A little refactored version from Wikipedia Mercator article
+# Accepts both scalars and numpy arrays
 def latLon2MercXY(lat, lon):
-    if lat > 89.5:
-        lat = 89.5
-    if lat < -89.5:
-        lat = -89.5
+    lat = np.clip(lat, -89.5, 89.5)
  
-    rLat = math.radians(lat)
-    rLong = math.radians(lon)
+    rLat = np.radians(lat)
+    rLong = np.radians(lon)
  
     a = 6378137.0
     b = 6356752.3142
     f = (a - b)/a
     e = math.sqrt(2*f - f**2)
     x = a*rLong
-    y = a*math.log(math.tan(math.pi/4 + rLat/2)*((1 - e*math.sin(rLat))/(1 + e*math.sin(rLat)))**(e/2))
+    y = a*np.log(np.tan(math.pi/4 + rLat/2)*((1 - e*np.sin(rLat))/(1 + e*np.sin(rLat)))**(e/2))
     return (x, y)
 ##########################################################################
+# Accepts both scalars and numpy arrays
 def getDist3D(lat1, lon1, alt1, lat2, lon2, alt2):
-    R = 6378.137; 
-    dLat = (lat2 - lat1)*math.pi/180;
-    dLon = (lon2 - lon1)*math.pi/180;
-    a = math.sin(dLat/2)*math.sin(dLat/2) + math.cos(lat1 * math.pi / 180) * math.cos(lat2 * math.pi / 180) * math.sin(dLon/2) * math.sin(dLon/2);
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = R * c * 1000
-    dAlt = alt2 - alt1
-    return math.sqrt(dAlt**2 + d**2) # in meters
+    d = getDist2D(lat1, lon1, lat2, lon2)
+    dAlt = np.subtract(alt2, alt1)
+    return np.sqrt(dAlt**2 + d**2) # in meters
 ##########################################################################
+# Accepts both scalars and numpy arrays
 def getDist2D(lat1, lon1, lat2, lon2):
     R = 6378.137; 
-    dLat = (lat2 - lat1)*math.pi/180;
-    dLon = (lon2 - lon1)*math.pi/180;
-    a = math.sin(dLat/2)*math.sin(dLat/2) + math.cos(lat1 * math.pi / 180) * math.cos(lat2 * math.pi / 180) * math.sin(dLon/2) * math.sin(dLon/2);
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    dLat = np.radians(np.subtract(lat2, lat1))
+    dLon = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(dLat/2)**2 + np.cos(np.radians(lat1))*np.cos(np.radians(lat2))*np.sin(dLon/2)**2
+    c = 2*np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     d = R * c
     return d * 1000 # in meters
 ##########################################################################
-def readGPX(filename, setTimeIndex=True, interpolateToSeconds=False):
-    tree = etree.parse(filename)
-    
-    pts = tree.findall('{http://www.topografix.com/GPX/1/1}trk')[0].findall('{http://www.topografix.com/GPX/1/1}trkseg')[0].findall('{http://www.topografix.com/GPX/1/1}trkpt')
-    recs = []
-    prevLat, prevLon = None, None
-    prevTimeStamp = None
-    prevEle = None
-    for pt in pts:
-        try:
-            time = np.datetime64(pt.findall('{http://www.topografix.com/GPX/1/1}time')[0].text.replace('Z', ''))
-        except:
-            time = np.datetime64(0)
-        timestamp = int((time - np.datetime64('1970-01-01T00:00:00')) / np.timedelta64(1, 's'))
+NS_GPX = '{http://www.topografix.com/GPX/1/1}'
+NS_TPX = '{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}'
+##########################################################################
+def _parseFloat(el, default):
+    try:
+        return float(el.text)
+    except:
+        return default
+##########################################################################
+RAW_COLUMNS = ['time', 'power', 'cadence', 'hr', 'ele', 'lat', 'lon', 'segment']
+##########################################################################
+def _appendPoint(rows, pt, segment):
+    '''
+    Appends one <trkpt> element to the [rows] dict of lists. Missing values
+    fall back to epoch time and zeros for sensors and coordinates.
+    '''
+    el = pt.find(NS_GPX + 'time')
+    rows['time'].append(el.text.replace('Z', '') if el is not None and el.text else '1970-01-01T00:00:00')
+    rows['ele'].append(_parseFloat(pt.find(NS_GPX + 'ele'), 0.0))
+    try:
+        rows['lat'].append(float(pt.attrib['lat']))
+        rows['lon'].append(float(pt.attrib['lon']))
+    except:
+        rows['lat'].append(0.0)
+        rows['lon'].append(0.0)
 
-        try:
-            power = float(pt.findall('{http://www.topografix.com/GPX/1/1}extensions')[0].findall('{http://www.topografix.com/GPX/1/1}power')[0].text)
-        except:
-            power = 0.0
-        try:
-            cadence = int(pt.findall('{http://www.topografix.com/GPX/1/1}extensions')[0].findall('{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}TrackPointExtension')[0].findall('{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}cad')[0].text)
-        except:
-            cadence = 0;
-        try:
-            hr = int(pt.findall('{http://www.topografix.com/GPX/1/1}extensions')[0].findall('{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}TrackPointExtension')[0].findall('{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}hr')[0].text)
-        except:
-            hr = 0
-        try: 
-            ele = float(pt.findall('{http://www.topografix.com/GPX/1/1}ele')[0].text)
-        except:
-            ele = 0
-        try:
-            lat = float(pt.attrib['lat'])
-            lon = float(pt.attrib['lon'])
-        except:
-            lat = 0.0
-            lon = 0.0
-        try:
-            x, y = latLon2MercXY(lat, lon)
-        except:
-            x, y = (0, 0)
-            
-        try:
-            d = getDist3D(prevLat, prevLon, prevEle, lat, lon, ele)/1000
-            dt = (timestamp - prevTimeStamp)/3600.0
-            vel = d/dt
-        except:
-            vel = 0
-        
-        prevLat = lat
-        prevLon = lon
-        prevEle = ele
-        prevTimeStamp = timestamp
-        
-        recs.append({'time': time, 'timestamp': timestamp, 'power': power, 'cadence': cadence, 'hr': hr, 'ele': ele, 'lat': lat, 'lon': lon, 'x': x, 'y': y, 'vel': vel, 'vel_filt': vel})
-        pass
-    
-    filterRadius = 1
-    for i in range(filterRadius, len(recs) - filterRadius - 1):
-        try:
-            lat1 = recs[i - filterRadius]['lat']
-            lat2 = recs[i + filterRadius]['lat']
-            lon1 = recs[i - filterRadius]['lon']
-            lon2 = recs[i + filterRadius]['lon']
-            ele1 = recs[i - filterRadius]['ele']
-            ele2 = recs[i + filterRadius]['ele']
-            t1 = recs[i - filterRadius]['timestamp']
-            t2 = recs[i + filterRadius]['timestamp']
-            dt = (t2 - t1)/3600.0
-            d = getDist3D(lat1, lon1, ele1, lat2, lon2, ele2)/1000
-            recs[i]['vel_filt'] = d/dt
-        except:
-            pass
+    ext = pt.find(NS_GPX + 'extensions')
+    tpx = ext.find(NS_TPX + 'TrackPointExtension') if ext is not None else None
+    rows['power'].append(_parseFloat(ext.find(NS_GPX + 'power'), 0.0) if ext is not None else 0.0)
+    rows['cadence'].append(_parseFloat(tpx.find(NS_TPX + 'cad'), 0) if tpx is not None else 0)
+    rows['hr'].append(_parseFloat(tpx.find(NS_TPX + 'hr'), 0) if tpx is not None else 0)
+    rows['segment'].append(segment)
+##########################################################################
+def _rowsToColumns(rows):
+    try:
+        time = np.array(rows['time'], dtype='datetime64[s]')
+    except:
+        # Malformed timestamps somewhere: fall back to per-item parsing
+        time = np.array([_parseTime(t) for t in rows['time']], dtype='datetime64[s]')
+
+    return {
+        'time': time,
+        'power': np.array(rows['power'], dtype=np.float64),
+        'cadence': np.array(rows['cadence'], dtype=np.float64).astype(np.int64),
+        'hr': np.array(rows['hr'], dtype=np.float64).astype(np.int64),
+        'ele': np.array(rows['ele'], dtype=np.float64),
+        'lat': np.array(rows['lat'], dtype=np.float64),
+        'lon': np.array(rows['lon'], dtype=np.float64),
+        'segment': np.array(rows['segment'], dtype=np.int64),
+        }
+##########################################################################
+def _parseTime(text):
+    try:
+        return np.datetime64(text, 's')
+    except:
+        return np.datetime64(0, 's')
+##########################################################################
+def iterGPXBatches(filename, batchSize=10000):
+    '''
+    Incremental reader. Walks every <trk>/<trkseg> of the file and yields
+    dicts of raw numpy columns (see RAW_COLUMNS) of up to [batchSize] points.
+    Elements are freed as soon as they are read, so memory stays bounded
+    by the batch size rather than the file size. 'segment' is a running
+    index over all track segments of the file.
+    '''
+    rows = {c: [] for c in RAW_COLUMNS}
+    segment = -1
+    curSeg = None
+    for event, elem in etree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == NS_GPX + 'trkseg':
+                segment += 1
+                curSeg = elem
+            continue
+
+        if elem.tag == NS_GPX + 'trkpt':
+            _appendPoint(rows, elem, segment)
+            elem.clear()
+            if curSeg is not None:
+                curSeg.remove(elem)
+            if len(rows['time']) >= batchSize:
+                yield _rowsToColumns(rows)
+                rows = {c: [] for c in RAW_COLUMNS}
+        elif elem.tag == NS_GPX + 'trkseg':
+            curSeg = None
+            elem.clear()
+        elif elem.tag == NS_GPX + 'trk':
+            elem.clear()
+
+    if len(rows['time']) > 0:
+        yield _rowsToColumns(rows)
+##########################################################################
+# vel_filt smoothing methods, see smoothSpeed()
+SMOOTHING_METHODS = ['window', 'median', 'savgol', 'kalman']
+SAVGOL_ORDER = 2
+##########################################################################
+def _segmentBounds(seg):
+    '''
+    (start, end) index pairs of the runs of equal [seg] values.
+    '''
+    starts = np.nonzero(np.r_[True, seg[1:] != seg[:-1]])[0] if len(seg) > 0 else np.array([], dtype=np.int64)
+    return zip(starts, np.r_[starts[1:], len(seg)])
+##########################################################################
+def _fillGaps(v):
+    '''
+    NaNs replaced by linear interpolation between the known values (the
+    nearest known one at the ends), zeros if nothing is known.
+    '''
+    known = ~np.isnan(v)
+    if known.all():
+        return v
+    if not known.any():
+        return np.zeros(len(v))
+    ind = np.arange(len(v))
+    return np.interp(ind, ind[known], v[known])
+##########################################################################
+def _windowSpeed(lat, lon, ele, timestamp, hasTime, seg, vel, r):
+    # Centered window, same borders as the former loop: range(r, n - r - 1).
+    # Points the window can't be computed for keep their raw speed. Where
+    # that's unknown as well (NaN), e.g. at every segment start, it's
+    # filled from the segment's known speeds: the first valid step seeds
+    # the start instead of a drop to 0
+    n = len(vel)
+    velFilt = vel.copy()
+    ind = np.arange(r, n - r - 1)
+    if len(ind) > 0:
+        i1 = ind - r
+        i2 = ind + r
+        d = getDist3D(lat[i1], lon[i1], ele[i1], lat[i2], lon[i2], ele[i2])/1000
+        dt = (timestamp[i2] - timestamp[i1])/3600.0
+        ok = (dt > 0) & hasTime[i1] & hasTime[i2] & (seg[i1] == seg[i2])
+        velFilt[ind[ok]] = d[ok]/dt[ok]
+    for i1, i2 in _segmentBounds(seg):
+        velFilt[i1:i2] = _fillGaps(velFilt[i1:i2])
+    return velFilt
+##########################################################################
+def _medianSpeed(vel, seg, r):
+    # Unknown speeds and the other segments' points are NaN in the windows
+    pad = np.full(r, np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(np.concatenate([pad, vel, pad]), 2*r + 1)
+    segs = np.lib.stride_tricks.sliding_window_view(np.concatenate([np.full(r, -1), seg, np.full(r, -1)]), 2*r + 1)
+    windows = np.where(segs == seg[:, None], windows, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(windows, axis=1)
+##########################################################################
+def _savgolSpeed(v, r, order):
+    '''
+    Savitzky-Golay smoothing of one gapless run. Points closer than [r] to
+    an end take their value from the polynomial fitted to the first (last)
+    full window, the usual way. A window of [order] + 1 points or fewer is
+    just interpolated by the polynomial, so [r] is raised to the smallest
+    one that smooths.
+    '''
+    m = len(v)
+    r = min(max(r, order//2 + 1), (m - 1)//2)
+    if r < 1:
+        return v
+    w = 2*r + 1
+    j = np.arange(-r, r + 1)
+    A = j[:, None]**np.arange(min(order, w - 1) + 1)
+    # Row i: the fitted polynomial value at window position i
+    H = A.dot(np.linalg.pinv(A))
+    out = np.empty(m)
+    out[r:m - r] = np.lib.stride_tricks.sliding_window_view(v, w).dot(H[r])
+    out[:r] = H[:r].dot(v[:w])
+    out[m - r:] = H[r + 1:].dot(v[m - w:])
+    return out
+##########################################################################
+def _kalmanSpeed(v, t, tau):
+    '''
+    Random walk speed model, forward Kalman filter plus the RTS smoother
+    pass, so there's no lag. Process noise grows with the actual time step
+    ([t] in seconds, non-decreasing), unknown speeds (NaN) are predicted
+    only. The process to measurement
+    noise ratio is 1/[tau]^2 per second, which makes [tau] roughly the
+    smoothing time constant in seconds. The filter starts at the first
+    known speed, the points before it take the smoothed value there. The
+    one method that can't be done as array operations: two plain loops.
+    '''
+    m = len(v)
+    known = np.nonzero(~np.isnan(v))[0]
+    if len(known) == 0:
+        return v
+    k0 = known[0]
+    q = 1.0/(tau*tau)
+    z = v.tolist()
+    dts = np.r_[0.0, np.maximum(np.diff(t), 0)].tolist()
+    xf = [0.0]*m
+    pf = [0.0]*m
+    pp = [0.0]*m
+    x = 0.0
+    p = 1e6
+    for k in range(k0, m):
+        ppk = p + q*dts[k]
+        pp[k] = ppk
+        if z[k] == z[k]:
+            g = ppk/(ppk + 1.0)
+            x = x + g*(z[k] - x)
+            p = (1.0 - g)*ppk
+        else:
+            p = ppk
+        xf[k] = x
+        pf[k] = p
+    xs = xf[:]
+    for k in range(m - 2, k0 - 1, -1):
+        c = pf[k]/pp[k + 1] if pp[k + 1] > 0 else 0.0
+        xs[k] = xf[k] + c*(xs[k + 1] - xf[k])
+    xs[:k0] = [xs[k0]]*k0
+    return np.array(xs)
+##########################################################################
+def smoothSpeed(vel, timestamp, seg, method, radius=1):
+    '''
+    Smoothed speed from the raw per-point one, [vel] NaN where unknown.
+    Never mixes two segments. [method] and [radius]:
+        'median' - rolling median of 2*radius + 1 points
+        'savgol' - Savitzky-Golay, 2*radius + 1 points (at least
+                   SAVGOL_ORDER + 2, rounded up to odd), SAVGOL_ORDER
+        'kalman' - Kalman smoother with a time constant of [radius] seconds
+    There's no default [method]: the readGPX() one, 'window', needs the
+    coordinates and is done in _computeDerived(). Unknown speeds
+    are skipped by 'median' and 'kalman' and interpolated over for
+    'savgol'. Like with 'window', a point with no known speed in reach
+    (e.g. a segment start with radius 0) is filled from its segment's
+    smoothed speeds, so a segment starts at its first known speed rather
+    than 0; a segment with no known speed at all is 0.
+    '''
+    if len(vel) == 0:
+        return np.zeros(0)
+    if method == 'median':
+        result = _medianSpeed(vel, seg, int(radius))
+        for i1, i2 in _segmentBounds(seg):
+            result[i1:i2] = _fillGaps(result[i1:i2])
+    elif method == 'savgol' or method == 'kalman':
+        result = np.empty(len(vel))
+        for i1, i2 in _segmentBounds(seg):
+            if method == 'savgol':
+                result[i1:i2] = _savgolSpeed(_fillGaps(vel[i1:i2]), int(radius), SAVGOL_ORDER)
+            else:
+                # Missing timestamps are in between their neighbours
+                t = np.where(timestamp[i1:i2] != 0, timestamp[i1:i2], np.nan)
+                result[i1:i2] = _kalmanSpeed(vel[i1:i2], _fillGaps(t), max(radius, 1e-3))
+    else:
+        raise ValueError('Unknown smoothing method: ' + str(method))
+    return np.where(np.isnan(result), 0.0, result)
+##########################################################################
+def _computeDerived(cols, smoothing='window', smoothingRadius=1):
+    '''
+    Adds timestamp, x, y, vel and vel_filt columns computed as array
+    operations. Speeds are in km/h. Speed is never computed across a
+    segment boundary, over a zero or negative time step or from a point
+    without a timestamp (those are parsed as the epoch start): it's
+    unknown there, which is 0 in [vel]. The first point of each segment is
+    such a point.
+
+    vel_filt is [vel] smoothed by [smoothing]: the default 'window' is the
+    distance over time between the points [smoothingRadius] before and
+    after, the other methods are those of smoothSpeed().
+    '''
+    if not smoothing in SMOOTHING_METHODS:
+        raise ValueError('Unknown smoothing method: ' + str(smoothing))
+    n = len(cols['time'])
+    timestamp = cols['time'].astype(np.int64)
+    hasTime = timestamp != 0
+    lat, lon, ele, seg = cols['lat'], cols['lon'], cols['ele'], cols['segment']
+    x, y = latLon2MercXY(lat, lon)
+
+    vel = np.full(n, np.nan)
+    if n > 1:
+        d = getDist3D(lat[:-1], lon[:-1], ele[:-1], lat[1:], lon[1:], ele[1:])/1000
+        dt = np.diff(timestamp)/3600.0
+        ok = (dt > 0) & hasTime[1:] & hasTime[:-1] & (seg[1:] == seg[:-1])
+        vel[1:][ok] = d[ok]/dt[ok]
+
+    if smoothing == 'window':
+        velFilt = _windowSpeed(lat, lon, ele, timestamp, hasTime, seg, vel, smoothingRadius)
+    else:
+        velFilt = smoothSpeed(vel, timestamp, seg, smoothing, smoothingRadius)
+
+    cols['timestamp'] = timestamp
+    cols['x'] = np.asarray(x, dtype=np.float64)
+    cols['y'] = np.asarray(y, dtype=np.float64)
+    cols['vel'] = np.where(np.isnan(vel), 0.0, vel)
+    cols['vel_filt'] = velFilt
+    return cols
+##########################################################################
+COLUMNS = ['time', 'timestamp', 'power', 'cadence', 'hr', 'ele', 'lat', 'lon', 'x', 'y', 'vel', 'vel_filt', 'segment']
+##########################################################################
+def readGPX(filename, setTimeIndex=True, interpolateToSeconds=False, batchSize=10000, smoothing='window', smoothingRadius=1):
+    '''
+    Parses [filename] into a DataFrame of COLUMNS. [smoothing] and
+    [smoothingRadius] select how vel_filt is computed, see _computeDerived.
+    '''
+    batches = list(iterGPXBatches(filename, batchSize))
+    if len(batches) > 0:
+        cols = {c: np.concatenate([b[c] for b in batches]) for c in RAW_COLUMNS}
+    else:
+        cols = _rowsToColumns({c: [] for c in RAW_COLUMNS})
+    del batches
+    cols = _computeDerived(cols, smoothing, smoothingRadius)
     
-    result = pd.DataFrame(recs);
-    #result['vel_filt'] = result['vel'].rolling(window=3).mean()
+    result = pd.DataFrame({c: cols[c] for c in COLUMNS})
     
     if (setTimeIndex):
         result.set_index(pd.DatetimeIndex(result['time']), inplace=True)
@@ -176,6 +398,77 @@ def getRecordForTimeAndOffset(data, time, timeOffsetMS):
         
     return res
     
+##########################################################################
+class TelemetryTimeline:
+    '''
+    Per-frame telemetry table. Every field is interpolated for every frame
+    in one vectorized pass at construction time, so the render loop only
+    has to pick a row.
+
+    [startTime] is the telemetry time of the video position 0 (with the
+    whole-second offset already applied), [frameOffsetsMS] are per-frame
+    offsets from it in milliseconds. Frames outside of the track get the
+    first/last record values, same as getRecordForTimeAndOffset does.
+    '''
+    FIELDS = ['x', 'y', 'cadence', 'ele', 'hr', 'lat', 'lon', 'power', 'timestamp', 'vel', 'vel_filt']
+
+    def __init__(self, data, startTime, frameOffsetsMS):
+        self.offsetsMS = np.asarray(frameOffsetsMS, dtype=np.float64)
+        startMS = pd.Timestamp(startTime).value/1e6
+        t = startMS + self.offsetsMS
+        
+        src = data['time'].to_numpy().astype('datetime64[ms]').astype(np.int64).astype(np.float64)
+        order = np.argsort(src, kind='stable')
+        src = src[order]
+        
+        self.fields = {}
+        for f in self.FIELDS:
+            if f in data:
+                self.fields[f] = np.interp(t, src, data[f].to_numpy()[order].astype(np.float64))
+        if 'segment' in data:
+            pad = np.clip(np.searchsorted(src, t, side='right') - 1, 0, len(src) - 1)
+            self.fields['segment'] = data['segment'].to_numpy()[order][pad]
+        self.fields['time'] = t.astype(np.int64).astype('datetime64[ms]')
+        
+        self.outOfRange = (t < src[0]) | (t > src[-1])
+        self.outOfRangeCount = int(self.outOfRange.sum())
+# ------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.offsetsMS)
+# ------------------------------------------------------------------------
+    def record(self, frameInd):
+        rec = {f: v[frameInd] for f, v in self.fields.items()}
+        rec['time'] = pd.Timestamp(rec['time'])
+        rec['frame'] = frameInd
+        return rec
+# ------------------------------------------------------------------------
+    def frameForOffset(self, offsetMS):
+        '''
+        Index of the frame closest to [offsetMS]. Offsets are expected to be
+        sorted, which is always the case for constructed timelines.
+        '''
+        ind = int(np.searchsorted(self.offsetsMS, offsetMS))
+        if ind >= len(self.offsetsMS):
+            return len(self.offsetsMS) - 1
+        if ind > 0 and offsetMS - self.offsetsMS[ind - 1] < self.offsetsMS[ind] - offsetMS:
+            return ind - 1
+        return ind
+# ------------------------------------------------------------------------
+    def recordForOffset(self, offsetMS):
+        return self.record(self.frameForOffset(offsetMS))
+##########################################################################
+def makeFrameTimeline(data, videoTime, fps, timingStart, timingEnd, diffTimeMS=0):
+    '''
+    Timeline for video frames falling into [timingStart, timingEnd) seconds
+    (offset-corrected, as used by overlay_drawer.py). Frame times follow the
+    container frame rate: frame k is at k*1000/fps ms of the source video.
+    '''
+    frameMS = 1000.0/fps
+    k0 = int(math.floor((timingStart*1000 + diffTimeMS)/frameMS))
+    k1 = int(math.ceil((timingEnd*1000 + diffTimeMS)/frameMS)) + 1
+    offsets = np.arange(max(k0, 0), max(k1, 0))*frameMS - diffTimeMS
+    return TelemetryTimeline(data, videoTime, offsets)
+    
 ##########################################################################
 if __name__ == '__main__':
     # Test section
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''
+                  PARSED TRACK CACHE
+Not intended for a standalone distribution. Just a helpers collection here.
+
+Keeps the columns produced by strava_gpx.readGPX as plain .npy files, one
+directory per entry:
+
+    <cacheDir>/<key>/<column>.npy
+    <cacheDir>/<key>/meta.json
+    <cacheDir>/index.json
+
+The key is a hash of the GPX file content, the parse options and the cache
+format version, so a changed file never hits a stale entry. index.json maps
+source paths to their last known (size, mtime, key) so a warm start doesn't
+even have to re-hash the file.
+
+Columns are opened memory-mapped (read-only) and the frame is built from
+them without copying, one pandas block per column, so loading a cached
+track reads nothing up front. That lasts as long as pandas keeps the blocks
+apart: operations that consolidate columns (e.g. df.values over mixed
+dtypes) make in-memory copies. The cache guarantees no re-parsing, not a
+zero-copy frame for its whole lifetime.
+
+A cached frame is read-only: writing into its columns raises "assignment
+destination is read-only" (df[c].values[...] = ... always, df.loc[...] = ...
+with pandas before copy-on-write). Adding new columns is fine; call
+df.copy() before modifying existing ones.
+'''
+
+import strava_gpx as strava
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import time
+
+CACHE_VERSION = 4
+INDEX_COLUMN = '__index__'
+
+##########################################################################
+def fileHash(filename, chunkSize=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+##########################################################################
+def cacheKey(contentHash, options):
+    keyData = json.dumps({'v': CACHE_VERSION, 'hash': contentHash, 'options': options}, sort_keys=True, default=str)
+    return hashlib.sha1(keyData.encode('utf-8')).hexdigest()
+##########################################################################
+def _readJson(filename, default):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except:
+        return default
+##########################################################################
+def _writeJson(filename, data):
+    tmp = filename + '.tmp%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
+##########################################################################
+def _entrySize(entryDir):
+    total = 0
+    for name in os.listdir(entryDir):
+        total += os.path.getsize(os.path.join(entryDir, name))
+    return total
+##########################################################################
+def _loadEntry(entryDir, setTimeIndex):
+    meta = _readJson(os.path.join(entryDir, 'meta.json'), None)
+    if meta is None:
+        return None
+    cols = {}
+    for c in meta['columns']:
+        cols[c] = np.load(os.path.join(entryDir, c + '.npy'), mmap_mode='r')
+    index = cols.pop(INDEX_COLUMN, None)
+    # A dict of arrays with copy=False isn't consolidated: every memmap
+    # stays its own block
+    result = pd.DataFrame(cols, copy=False)
+    if setTimeIndex and index is not None:
+        result.set_index(pd.DatetimeIndex(index, name=meta.get('indexName')), inplace=True)
+    # Touch for LRU eviction
+    os.utime(os.path.join(entryDir, 'meta.json'))
+    return result
+##########################################################################
+def _storeEntry(cacheDir, key, data, sourceFile):
+    entryDir = os.path.join(cacheDir, key)
+    tmpDir = entryDir + '.tmp%d' % os.getpid()
+    os.makedirs(tmpDir, exist_ok=True)
+    columns = []
+    for c in data.columns:
+        arr = data[c].to_numpy()
+        if arr.dtype == object:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            return False
+        np.save(os.path.join(tmpDir, c + '.npy'), arr)
+        columns.append(c)
+    if isinstance(data.index, pd.DatetimeIndex):
+        np.save(os.path.join(tmpDir, INDEX_COLUMN + '.npy'), data.index.to_numpy())
+        columns.append(INDEX_COLUMN)
+    meta = {'columns': columns, 'indexName': data.index.name, 'source': os.path.abspath(sourceFile), 'created': time.time()}
+    _writeJson(os.path.join(tmpDir, 'meta.json'), meta)
+    try:
+        os.rename(tmpDir, entryDir)
+    except OSError:
+        # Another process stored the same entry meanwhile
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    return True
+##########################################################################
+def evict(cacheDir, maxCacheMB):
+    '''
+    Removes least recently used entries until the cache fits [maxCacheMB].
+    '''
+    entries = []
+    for name in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, name)
+        metaFile = os.path.join(entryDir, 'meta.json')
+        if not os.path.isdir(entryDir) or not os.path.exists(metaFile):
+            continue
+        entries.append((os.path.getmtime(metaFile), _entrySize(entryDir), entryDir))
+
+    total = sum(e[1] for e in entries)
+    limit = maxCacheMB*1024*1024
+    for _, size, entryDir in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(entryDir, ignore_errors=True)
+        total -= size
+##########################################################################
+def readGPXCached(filename, cacheDir='.track_cache', maxCacheMB=512, setTimeIndex=True, interpolateToSeconds=False,
+                  smoothing='window', smoothingRadius=1):
+    '''
+    Drop-in replacement for strava_gpx.readGPX for callers that only read
+    the frame: a cached one is read-only, .copy() it before modifying (see
+    the module doc). Falls back to plain parsing if [cacheDir] is None.
+    '''
+    if cacheDir is None:
+        return strava.readGPX(filename, setTimeIndex=setTimeIndex, interpolateToSeconds=interpolateToSeconds,
+                              smoothing=smoothing, smoothingRadius=smoothingRadius)
+
+    os.makedirs(cacheDir, exist_ok=True)
+    options = {'interpolateToSeconds': interpolateToSeconds, 'smoothing': smoothing, 'smoothingRadius': smoothingRadius}
+
+    # Fast path: the file hasn't changed since the last time we hashed it
+    indexFile = os.path.join(cacheDir, 'index.json')
+    index = _readJson(indexFile, {})
+    src = os.path.abspath(filename)
+    st = os.stat(filename)
+    optKey = json.dumps(options, sort_keys=True)
+    known = index.get(src, {}).get(optKey)
+    if known is not None and known['size'] == st.st_size and known['mtime_ns'] == st.st_mtime_ns:
+        key = known['key']
+    else:
+        key = cacheKey(fileHash(filename), options)
+
+    entryDir = os.path.join(cacheDir, key)
+    if os.path.isdir(entryDir):
+        try:
+            result = _loadEntry(entryDir, setTimeIndex)
+        except:
+            result = None
+            shutil.rmtree(entryDir, ignore_errors=True)
+        if result is not None:
+            if known is None or known['key'] != key:
+                index.setdefault(src, {})[optKey] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'key': key}
+                _writeJson(indexFile, index)
+            return result
+
+    result = strava.readGPX(filename, setTimeIndex=True, interpolateToSeconds=interpolateToSeconds,
+                            smoothing=smoothing, smoothingRadius=smoothingRadius)
+    if _storeEntry(cacheDir, key, result, filename):
+        index.setdefault(src, {})[optKey] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'key': key}
+        _writeJson(indexFile, index)
+        evict(cacheDir, maxCacheMB)
+
+    if not setTimeIndex:
+        result = result.reset_index(drop=True)
+    return result
+##########################################################################
+if __name__ == '__main__':
+    # Test section
+    t = time.time()
+    df = readGPXCached('downhill.gpx')
+    print('First read: %.3f s' % (time.time() - t))
+    t = time.time()
+    df = readGPXCached('downhill.gpx')
+    print('Warm read : %.3f s' % (time.time() - t))
+    print(df)
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+'''
+                  VIDEO INPUT/OUTPUT HELPERS
+Not intended for a standalone distribution. Just a helpers collection here.
+
+Frame writers share one tiny interface: write(frame) and release().
+makeVideoWriter() picks the backend: ffmpeg over a pipe or OpenCV's
+VideoWriter as the fallback. concatSegments() joins separately rendered
+parts of one clip without re-encoding.
+
+ScrubReader is the input side for the interactive tools: stepping back and
+forth over a video frame by frame, optionally over a low-resolution proxy
+of it (see loadProxy()).
+'''
+
+import numpy as np
+import bisect
+import cv2
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+
+##########################################################################
+def seekNear(cap, targetMS, prerollMS=1000):
+    '''
+    Positions [cap] shortly before [targetMS] (source video time) instead of
+    decoding everything from the file start. The backend seeks to the
+    closest preceding keyframe and decodes forward from there, so the
+    caller still gets exact frames and CAP_PROP_POS_MSEC keeps reporting the
+    original timestamps. The caller is expected to skip the frames before
+    [targetMS] as usual: it's only [prerollMS] of them.
+
+    Falls back to the file start if the backend overshoots the target.
+    Returns the position of the last consumed frame (ms) or 0.
+    '''
+    seekMS = targetMS - prerollMS
+    if seekMS <= 0:
+        return 0
+
+    cap.set(cv2.CAP_PROP_POS_MSEC, seekMS)
+    ret, _ = cap.read()
+    posMS = cap.get(cv2.CAP_PROP_POS_MSEC)
+    if ret and posMS < targetMS:
+        return posMS
+
+    # Inaccurate seek (or no seeking support at all): play it safe
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return 0
+##########################################################################
+def keyframeIndex(videoFileName):
+    '''
+    Ascending frame numbers of the video keyframes. Only the packets are
+    read, nothing is decoded, so it's quick even for long clips. With
+    B-frames a packet number is at most the frame's display number, so the
+    values are safe seek starts. Returns None if the backend can't tell
+    keyframes.
+    '''
+    if not hasattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME'):
+        return None
+    cap = cv2.VideoCapture(videoFileName, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    if not cap.isOpened():
+        return None
+    keyframes = []
+    n = 0
+    while cap.grab():
+        if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(n)
+        n += 1
+    cap.release()
+    if len(keyframes) == 0 or keyframes[0] != 0:
+        return None
+    return keyframes
+##########################################################################
+class FrameRingBuffer:
+    '''
+    Decoded frames by frame number along with their timestamps (ms). Holds
+    at most [budgetMB] of frame data: the earliest added frames go first.
+    The last added frame is always kept.
+    '''
+    def __init__(self, budgetMB=256):
+        self.budget = int(budgetMB*1024*1024)
+        self.frames = OrderedDict()
+        self.bytes = 0
+# ------------------------------------------------------------------------
+    def put(self, index, posMS, frame):
+        old = self.frames.pop(index, None)
+        if not old is None:
+            self.bytes -= old[1].nbytes
+        self.frames[index] = (posMS, frame)
+        self.bytes += frame.nbytes
+        while self.bytes > self.budget and len(self.frames) > 1:
+            _, (_, f) = self.frames.popitem(last=False)
+            self.bytes -= f.nbytes
+# ------------------------------------------------------------------------
+    def get(self, index):
+        return self.frames.get(index)
+# ------------------------------------------------------------------------
+    def __contains__(self, index):
+        return index in self.frames
+# ------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.frames)
+##########################################################################
+class ScrubReader:
+    '''
+    Frame-accurate stepping back and forth over [videoFileName]. Frames are
+    resized to fit [fitSize] (if given) and kept in a FrameRingBuffer of
+    [budgetMB], so going back over the recent ones is instant. Further
+    back the reader seeks to the closest preceding keyframe (the index is
+    built on open, see keyframeIndex()) and decodes forward from there: a
+    jump costs one GOP of decoding at most, and the frames decoded on the
+    way land in the buffer for the next steps back.
+
+    The current frame is [frame], its number [index] and its timestamp
+    [posMS] (CAP_PROP_POS_MSEC as it was when the frame was decoded). Given
+    per-frame [timestamps] are reported instead, e.g. the source video ones
+    when reading a proxy.
+    '''
+    def __init__(self, videoFileName, fitSize=None, budgetMB=256, timestamps=None):
+        self.cap = cv2.VideoCapture(videoFileName)
+        if not self.cap.isOpened():
+            raise IOError('Can\'t open ' + videoFileName)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.size = (self.width, self.height)
+        if not fitSize is None:
+            scale = min(float(fitSize[0])/self.width, float(fitSize[1])/self.height)
+            self.size = (int(self.width*scale), int(self.height*scale))
+        self.keyframes = keyframeIndex(videoFileName)
+        self.timestamps = timestamps
+        self.buffer = FrameRingBuffer(budgetMB)
+        # Number of the frame the next cap.read() returns
+        self.decoded = 0
+        self.index = -1
+        self.frame = None
+        self.posMS = 0.0
+# ------------------------------------------------------------------------
+    def _decodeNext(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            return False
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        if self.timestamps is None:
+            posMS = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        elif self.decoded < len(self.timestamps):
+            posMS = self.timestamps[self.decoded]
+        else:
+            return False
+        self.buffer.put(self.decoded, posMS, frame)
+        self.decoded += 1
+        return True
+# ------------------------------------------------------------------------
+    def _decodeStart(self, index):
+        '''
+        Frame number to decode from to get to [index]: the current decoder
+        position if it's no further than the keyframe before [index].
+        Without the keyframe index a second of video before [index] is
+        decoded (the backend seeks exactly anyway).
+        '''
+        if self.keyframes is None:
+            start = max(0, index - int(round(self.fps)))
+        else:
+            start = self.keyframes[max(0, bisect.bisect_right(self.keyframes, index) - 1)]
+        if start <= self.decoded <= index:
+            return self.decoded
+        return start
+# ------------------------------------------------------------------------
+    def seek(self, index):
+        '''
+        Makes frame [index] the current one. Returns False (and keeps the
+        current frame) if there's no such frame.
+        '''
+        if index < 0:
+            return False
+        if not index in self.buffer:
+            start = self._decodeStart(index)
+            if start != self.decoded:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+                self.decoded = start
+            while self.decoded <= index:
+                if not self._decodeNext():
+                    return False
+        self.index = index
+        self.posMS, self.frame = self.buffer.get(index)
+        return True
+# ------------------------------------------------------------------------
+    def step(self, n=1):
+        return self.seek(self.index + n)
+# ------------------------------------------------------------------------
+    def release(self):
+        self.cap.release()
+##########################################################################
+def proxyFileNames(videoFileName, proxyDir):
+    base = os.path.join(proxyDir, os.path.basename(videoFileName) + '.proxy')
+    return base + '.avi', base + '.json'
+##########################################################################
+def _sourceState(videoFileName):
+    st = os.stat(videoFileName)
+    return {'source': os.path.abspath(videoFileName), 'sourceSize': st.st_size, 'sourceMtime': st.st_mtime_ns}
+##########################################################################
+def buildProxy(videoFileName, proxyDir, fitSize, progressInterval=5.0):
+    '''
+    Decodes the whole video once and writes it downscaled to fit [fitSize]
+    as an MJPG .avi into [proxyDir]: every frame is a keyframe and a small
+    one, so the proxy seeks and decodes many times faster than the source.
+    The source frame timestamps (ms) go to a .json next to it along with
+    the source file size and mtime. Returns the proxy file name and the
+    timestamps.
+    '''
+    proxyFile, infoFile = proxyFileNames(videoFileName, proxyDir)
+    cap = cv2.VideoCapture(videoFileName)
+    if not cap.isOpened():
+        raise IOError('Can\'t open ' + videoFileName)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    scale = min(float(fitSize[0])/width, float(fitSize[1])/height)
+    size = (int(width*scale), int(height*scale))
+
+    os.makedirs(proxyDir, exist_ok=True)
+    # Still a *.proxy.avi name, so an interrupted build is git-ignored too
+    tmpFile = os.path.join(proxyDir, os.path.basename(videoFileName) + '.tmp.proxy.avi')
+    out = cv2.VideoWriter(tmpFile, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    if not out.isOpened():
+        cap.release()
+        raise IOError('Can\'t write ' + tmpFile)
+    timestamps = []
+    lastPrint = time.time()
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+        out.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+        if time.time() - lastPrint >= progressInterval:
+            print('Building proxy: %d s' % int(timestamps[-1]/1000))
+            lastPrint = time.time()
+    cap.release()
+    out.release()
+    os.replace(tmpFile, proxyFile)
+
+    info = _sourceState(videoFileName)
+    info.update(fitSize=list(fitSize), size=list(size), fps=fps, timestamps=timestamps)
+    with open(infoFile + '.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(infoFile + '.tmp', infoFile)
+    return proxyFile, timestamps
+##########################################################################
+def loadProxy(videoFileName, proxyDir, fitSize):
+    '''
+    The proxy file name and source timestamps for [videoFileName], built
+    first if it's missing or the source has changed since (see
+    buildProxy()).
+    '''
+    proxyFile, infoFile = proxyFileNames(videoFileName, proxyDir)
+    try:
+        with open(infoFile, 'r') as f:
+            info = json.load(f)
+        state = _sourceState(videoFileName)
+        if (os.path.exists(proxyFile) and info['fitSize'] == list(fitSize) and
+                all(info[k] == state[k] for k in ('sourceSize', 'sourceMtime'))):
+            return proxyFile, info['timestamps']
+    except (IOError, ValueError, KeyError):
+        pass
+    return buildProxy(videoFileName, proxyDir, fitSize)
+##########################################################################
+class ImageSequenceWriter:
+    '''
+    Writes every frame as a separate image file into [dirName]. With the
+    default PNG pattern 4-channel (BGRA) frames keep their alpha. Frames
+    of an earlier render into the same directory (file names matching
+    [pattern]) are deleted first, so a shorter render doesn't leave stale
+    ones after its last frame. Other files are left alone.
+    '''
+    def __init__(self, dirName, pattern='frame_%06d.png', startIndex=0):
+        os.makedirs(dirName, exist_ok=True)
+        framePattern = re.compile(re.sub(r'%0?\d*d', r'\\d+', re.escape(pattern)) + '$')
+        for name in os.listdir(dirName):
+            if framePattern.match(name):
+                os.remove(os.path.join(dirName, name))
+        self.dirName = dirName
+        self.pattern = pattern
+        self.index = startIndex
+# ------------------------------------------------------------------------
+    def write(self, frame):
+        fileName = os.path.join(self.dirName, self.pattern % self.index)
+        if not cv2.imwrite(fileName, frame):
+            raise IOError('Can\'t write ' + fileName)
+        self.index += 1
+# ------------------------------------------------------------------------
+    def release(self):
+        pass
+##########################################################################
+class FfmpegPipeWriter:
+    '''
+    Streams raw frames to a locally installed ffmpeg over a pipe. [pixFmt]
+    is the layout of the frames passed to write() ('bgr24' or 'bgra'),
+    [codecArgs] are the ffmpeg output options (codec, pixel format etc).
+    [extraInputArgs] add more inputs after the piped one (input #0), e.g.
+    a file to take the audio from.
+    '''
+    def __init__(self, outFile, size, fps, codecArgs, pixFmt='bgr24', ffmpegPath='ffmpeg', extraInputArgs=()):
+        cmd = [
+            ffmpegPath, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', pixFmt,
+            '-s', '%dx%d' % (size[0], size[1]), '-r', '%.6f' % fps,
+            '-i', '-',
+            ] + list(extraInputArgs) + list(codecArgs) + [outFile]
+        self.size = size
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+# ------------------------------------------------------------------------
+    def write(self, frame):
+        self.proc.stdin.write(frame.tobytes())
+# ------------------------------------------------------------------------
+    def release(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        ret = self.proc.wait()
+        self.proc = None
+        if ret != 0:
+            raise IOError('ffmpeg exited with code %d' % ret)
+##########################################################################
+# ffmpeg output options for alpha-capable intermediate codecs
+ALPHA_CODECS = {
+    'prores4444': ['-c:v', 'prores_ks', '-profile:v', '4444', '-pix_fmt', 'yuva444p10le'],
+    'qtrle': ['-c:v', 'qtrle', '-pix_fmt', 'argb'],
+    'png_mov': ['-c:v', 'png', '-pix_fmt', 'rgba'],
+    }
+##########################################################################
+def makeOverlayWriter(overlayFormat, outFile, size, fps, ffmpegPath='ffmpeg'):
+    '''
+    Writer for BGRA overlay frames: 'png' is an image sequence in the
+    [outFile] directory, the ALPHA_CODECS keys go through ffmpeg into a
+    .mov (or whatever container [outFile] names).
+    '''
+    if overlayFormat == 'png':
+        return ImageSequenceWriter(outFile)
+    if not overlayFormat in ALPHA_CODECS:
+        raise ValueError('Unknown overlay format: ' + str(overlayFormat))
+    return FfmpegPipeWriter(outFile, size, fps, ALPHA_CODECS[overlayFormat], pixFmt='bgra', ffmpegPath=ffmpegPath)
+##########################################################################
+class OpenCVWriter:
+    '''
+    cv2.VideoWriter behind the common writer interface. Codec support
+    depends on how the local OpenCV was built.
+    '''
+    def __init__(self, outFile, size, fps, encoding='h264'):
+        self.out = cv2.VideoWriter(outFile, cv2.VideoWriter_fourcc(*encoding), fps, size)
+        if not self.out.isOpened():
+            raise IOError('OpenCV can\'t open a \'%s\' writer for %s' % (encoding, outFile))
+# ------------------------------------------------------------------------
+    def write(self, frame):
+        self.out.write(frame)
+# ------------------------------------------------------------------------
+    def release(self):
+        self.out.release()
+##########################################################################
+def isFfmpegAvailable(ffmpegPath='ffmpeg'):
+    return not shutil.which(ffmpegPath) is None
+##########################################################################
+def ffmpegVideoArgs(codec='libx264', preset='medium', crf=18, threads=0, pixFmt='yuv420p'):
+    '''
+    ffmpeg output options for the rendered video. [preset] and [crf] are
+    only passed to codecs that understand them (x264/x265), [threads] of 0
+    lets the encoder decide.
+    '''
+    args = ['-c:v', codec]
+    if codec in ('libx264', 'libx265'):
+        args += ['-preset', preset, '-crf', str(crf)]
+    args += ['-threads', str(threads), '-pix_fmt', pixFmt]
+    return args
+##########################################################################
+def makeVideoWriter(backend, outFile, size, fps, encoding='h264', ffmpegPath='ffmpeg', ffmpegArgs=None, audioFrom=None, audioStartMS=0, audioCodec='aac'):
+    '''
+    Writer for BGR frames. [backend] is 'ffmpeg' or 'opencv'; 'ffmpeg'
+    falls back to OpenCV with the [encoding] fourcc if ffmpeg isn't found.
+
+    With ffmpeg the audio track of [audioFrom] (normally the source video)
+    starting at [audioStartMS] is muxed in, encoded with [audioCodec]
+    ('copy' keeps it as is if the output container allows). Sources
+    without audio are fine.
+    '''
+    if backend == 'ffmpeg':
+        if isFfmpegAvailable(ffmpegPath):
+            if ffmpegArgs is None:
+                ffmpegArgs = ffmpegVideoArgs()
+            inputArgs = []
+            codecArgs = list(ffmpegArgs)
+            if not audioFrom is None:
+                inputArgs = ['-ss', '%.3f' % (audioStartMS/1000.0), '-i', audioFrom]
+                codecArgs = ['-map', '0:v:0', '-map', '1:a:0?', '-c:a', audioCodec, '-shortest'] + codecArgs
+            return FfmpegPipeWriter(outFile, size, fps, codecArgs, pixFmt='bgr24', ffmpegPath=ffmpegPath, extraInputArgs=inputArgs)
+        print('Warning: ffmpeg not found, falling back to OpenCV writer')
+    elif backend != 'opencv':
+        raise ValueError('Unknown writer backend: ' + str(backend))
+    return OpenCVWriter(outFile, size, fps, encoding)
+##########################################################################
+def concatSegments(segFiles, outFile, ffmpegPath='ffmpeg', audioFrom=None, audioStartMS=0, audioCodec='aac'):
+    '''
+    Joins video files encoded with the same settings into [outFile] with
+    ffmpeg's concat demuxer. Video packets are copied, not re-encoded.
+    The audio of [audioFrom] starting at [audioStartMS] is muxed in the
+    same way makeVideoWriter() does it.
+    '''
+    listFile = outFile + '.concat.txt'
+    with open(listFile, 'w') as f:
+        for s in segFiles:
+            f.write('file \'%s\'\n' % os.path.abspath(s).replace('\'', '\'\\\'\''))
+
+    cmd = [ffmpegPath, '-hide_banner', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', listFile]
+    if not audioFrom is None:
+        cmd += ['-ss', '%.3f' % (audioStartMS/1000.0), '-i', audioFrom,
+                '-map', '0:v:0', '-map', '1:a:0?', '-c:a', audioCodec, '-shortest']
+    cmd += ['-c:v', 'copy', outFile]
+    try:
+        ret = subprocess.call(cmd)
+    finally:
+        os.remove(listFile)
+    if ret != 0:
+        raise IOError('ffmpeg concat exited with code %d' % ret)
+##########################################################################
+def benchmarkWriter(writer, frames, repeat=1):
+    '''
+    Writes [frames] [repeat] times and returns frames/sec including the
+    final flush on release().
+    '''
+    t = time.time()
+    for _ in range(repeat):
+        for f in frames:
+            writer.write(f)
+    writer.release()
+    return len(frames)*repeat/(time.time() - t)
+##########################################################################
+if __name__ == '__main__':
+    # Test section: writer backends throughput on synthetic 1080p frames
+    size = (1920, 1080)
+    fps = 30
+    rng = np.random.RandomState(0)
+    base = cv2.resize(rng.randint(0, 255, (108, 192, 3)).astype(np.uint8), size)
+    frames = [np.roll(base, 8*i, axis=1) for i in range(30)]
+    
+    tmpDir = tempfile.mkdtemp()
+    try:
+        out = os.path.join(tmpDir, 'cv.mp4')
+        for enc in ('h264', 'mp4v'):
+            try:
+                print('opencv %s: %.1f fps' % (enc, benchmarkWriter(OpenCVWriter(out, size, fps, enc), frames, 3)))
+            except IOError as e:
+                print('opencv %s: %s' % (enc, e))
+        if isFfmpegAvailable():
+            for preset in ('ultrafast', 'veryfast', 'medium'):
+                out = os.path.join(tmpDir, 'ff_%s.mp4' % preset)
+                w = makeVideoWriter('ffmpeg', out, size, fps, ffmpegArgs=ffmpegVideoArgs(preset=preset))
+                print('ffmpeg libx264 %s: %.1f fps' % (preset, benchmarkWriter(w, frames, 3)))
+        else:
+            print('ffmpeg: not found')
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
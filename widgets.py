@@ -2,18 +2,140 @@
 
 import PIL
 from PIL import ImageDraw, ImageFont
+from collections import OrderedDict
 import moment_track as moment
+import numpy as np
 
+##########################################################################
+class TextSprites:
+    '''
+    Cache of pre-rasterized text masks for numeric widgets with a bounded
+    set of values. Each mask is [size] large with the text drawn at (0, 0).
+    FreeType rasterization thus happens once per distinct string and
+    drawing a value becomes a single paste of the [fill] colour through
+    its mask, which gives exactly the pixels ImageDraw.text() does.
+    '''
+    def __init__(self, font, fill, size):
+        self.font = font
+        self.fill = fill
+        self.size = size
+        self.sprites = {}
+# ------------------------------------------------------------------------
+    def measure(font, texts):
+        # (w, h) area fitting every text of [texts] drawn at (0, 0)
+        boxes = [font.getbbox(t) for t in texts]
+        return (max(b[2] for b in boxes), max(b[3] for b in boxes))
+# ------------------------------------------------------------------------
+    def render(self, text):
+        mask = PIL.Image.new('L', self.size, 0)
+        draw = ImageDraw.Draw(mask)
+        draw.text((0, 0), text, font=self.font, fill=255)
+        del draw
+        return mask
+# ------------------------------------------------------------------------
+    def prerender(self, texts):
+        for t in texts:
+            self.get(t)
+# ------------------------------------------------------------------------
+    def get(self, text):
+        sprite = self.sprites.get(text)
+        if sprite is None:
+            sprite = self.render(text)
+            self.sprites[text] = sprite
+        return sprite
+# ------------------------------------------------------------------------
+    def layer(self, text, pos):
+        # [text] drawn at [pos] as a widget layer
+        return (self.fill, pos, self.get(text))
+# ------------------------------------------------------------------------
+    def memoryMB(self):
+        return len(self.sprites)*self.size[0]*self.size[1]/(1024*1024)
 ##########################################################################
 class Widget:
+    '''
+    Widgets are drawn either onto the full RGBA frame (draw) or as a list of
+    layers (layers) that the renderer pastes into their regions of the
+    frame only. A layer is a (source, (x, y), mask) triple in frame
+    coordinates, applied exactly as img.paste(source, (x, y), mask) on the
+    full frame: source is an RGBA image (usually its own mask) or a fill
+    colour. A widget supports layers by also reporting a bbox() covering
+    all of them. Widgets overriding draw() only keep working via a
+    full-frame fallback.
+    
+    [compositing] of 'paste' (default) pastes image layers through
+    themselves, exactly as the original full-frame drawing did. That also
+    lowers the frame's alpha under semi-transparent pixels, which shows as
+    a light haze once flattened onto white. 'over' alpha-composites image
+    layers instead: no haze, but the widgets look different.
+    
+    stateKey() is a cheap hashable summary of everything the widget's look
+    depends on (quantized the same way drawing does). The renderer calls
+    cachedLayers(), which reuses the previous layers while the key stays
+    the same. None means "always redraw".
+    
+    prepareTimeline() is an optional batch hook: the renderer calls it with
+    the per-frame TelemetryTimeline before drawing, so a widget can compute
+    its state for every frame at once (as array operations over
+    timeline.fields) and store it in [timelineState], a list indexed by
+    frame. frameState() then picks the state by the record's 'frame'.
+    Records without one, or a widget never given a timeline, take the
+    per-record path as before.
+    '''
     def __init__(self):
-        pass
+        self.compositing = 'paste'
+        self.lastStateKey = None
+        self.lastLayers = None
+        self.layersReused = False
+        self.layerHits = 0
+        self.layerMisses = 0
+        self.timelineState = None
+    def bbox(self):
+        # (x, y, w, h) in frame coordinates or None if unknown
+        return None
+    def layers(self, dataRecord):
+        # List of (source, (x, y), mask) to be pasted onto the frame in order
+        return None
+    def stateKey(self, dataRecord):
+        return None
+    def cachedLayers(self, dataRecord):
+        key = self.stateKey(dataRecord)
+        self.layersReused = key is not None and key == self.lastStateKey and self.lastLayers is not None
+        if self.layersReused:
+            self.layerHits += 1
+            return self.lastLayers
+        
+        self.layerMisses += 1
+        self.lastLayers = self.layers(dataRecord)
+        self.lastStateKey = key
+        return self.lastLayers
     def draw(self, img, dataRecord):
-        pass
+        layers = self.layers(dataRecord)
+        if not layers is None:
+            for source, pos, mask in layers:
+                img.paste(source, pos, mask)
     def prepare(self, fullData):
+        self.lastStateKey = None
+        self.lastLayers = None
+        self.timelineState = None
+    def prepareTimeline(self, timeline):
         pass
+    def frameState(self, dataRecord):
+        # Precomputed state of the record's frame or None
+        if self.timelineState is None:
+            return None
+        frame = dataRecord.get('frame')
+        if frame is None or not 0 <= frame < len(self.timelineState):
+            return None
+        return self.timelineState[frame]
     def clear(self):  
-        pass
+        self.lastLayers = None
+        self.timelineState = None
+    def stats(self):
+        # Widget-specific runtime info (caches etc.) for reporting
+        total = self.layerHits + self.layerMisses
+        if total == 0:
+            return {}
+        return {'layerHits': self.layerHits, 'layerMisses': self.layerMisses, 'layerHitRate': round(self.layerHits/total, 3)}
     def __del__(self):    
         try:
             self.clear()
@@ -21,23 +143,38 @@ class Widget:
                pass 
 ##########################################################################
 class Map (Widget):
-    def __init__(self, lineWidthInner, lineWidthOuter, pointerRadius):
+    '''
+    Static track map with a moving pointer. The track line is drawn from
+    the points moment_track.trackLOD() keeps for the widget size: with the
+    default [lodTolerance] of 0 the result is exactly the same as drawing
+    every point. A positive tolerance (pixels) simplifies further at the
+    cost of slightly different line edges, None draws every point.
+    '''
+    def __init__(self, lineWidthInner, lineWidthOuter, pointerRadius, lodTolerance=0):
         Widget.__init__(self)
         self.lineWidthInner = lineWidthInner
         self.lineWidthOuter = lineWidthOuter
         self.pointerRadius = pointerRadius
+        self.lodTolerance = lodTolerance
 # ------------------------------------------------------------------------
-    def getCurMap(self, rec):
-        curMap = self.mapImg.copy()
+    def pointerPos(self, rec):
+        # Top-left corner of the pointer sprite in frame coordinates
+        pos = self.frameState(rec)
+        if not pos is None:
+            return pos
         x, y = moment.ptScale(self.scaler, (rec['x'], rec['y']))
-        y = curMap.size[1] - y
-        
+        y = self.size[1] - y
         r = self.pointerRadius
-        draw = ImageDraw.Draw(curMap)
-        draw.ellipse([(x - r, y - r), (x + r, y + r)], fill=(255, 0, 0, 255), width=6)
-        del draw
-        
-        return curMap
+        return (self.pos[0] + x - r, self.pos[1] + y - r)
+# ------------------------------------------------------------------------
+    def prepareTimeline(self, timeline):
+        if not 'x' in timeline.fields or not 'y' in timeline.fields:
+            return
+        xs, ys = moment.ptScaleArray(self.scaler, timeline.fields['x'], timeline.fields['y'])
+        r = self.pointerRadius
+        xs = self.pos[0] + xs - r
+        ys = self.pos[1] + (self.size[1] - ys) - r
+        self.timelineState = list(zip(xs.tolist(), ys.tolist()))
 # ------------------------------------------------------------------------
     def prepare(self, fullData):
         Widget.prepare(self, fullData)
@@ -58,34 +195,55 @@ class Map (Widget):
 
         self.mapImg = PIL.Image.new('RGBA', self.size, (0, 0, 0, 0))
         
+        # Whole track projected at once
+        xs = fullData['x'].to_numpy()
+        ys = fullData['y'].to_numpy()
+        if not self.lodTolerance is None:
+            keep = moment.trackLOD(self.scaler, xs, ys, self.lodTolerance)
+            xs, ys = xs[keep], ys[keep]
+        xs, ys = moment.ptScaleArray(self.scaler, xs, ys)
+        ys = self.size[1] - ys
+        pts = list(zip(xs.tolist(), ys.tolist()))
+        
+        # Simplified to longer segments, the corners would show notches:
+        # drawn as a polyline with round joints then. Otherwise segment by
+        # segment, a wide polyline doesn't rasterize the same way
         draw = ImageDraw.Draw(self.mapImg)
+        if len(pts) > 1:
+            for fill, width in (((0, 0, 0, 155), self.lineWidthOuter), ((255, 255, 255, 200), self.lineWidthInner)):
+                if not self.lodTolerance is None and self.lodTolerance > 0:
+                    draw.line(pts, fill=fill, width=width, joint='curve')
+                else:
+                    for p0, p1 in zip(pts[1:], pts[:-1]):
+                        draw.line([p0, p1], fill=fill, width=width)
+        del draw
         
-        prevX = None
-        prevY = None
-        for ind, row in fullData.iterrows():
-            # Normal map
-            x, y = moment.ptScale(self.scaler, (row['x'], row['y']))
-            y = self.size[1] - y
-            if not prevX == None and not prevY == None:
-                draw.line([(x, y), (prevX, prevY)], fill=(0, 0, 0, 155), width=self.lineWidthOuter)
-            prevX = x
-            prevY = y
-        prevX = None
-        prevY = None
-        for ind, row in fullData.iterrows():
-            # Normal map
-            x, y = moment.ptScale(self.scaler, (row['x'], row['y']))
-            y = self.size[1] - y
-            if not prevX == None and not prevY == None:
-                draw.line([(x, y), (prevX, prevY)], fill=(255, 255, 255, 200), width=self.lineWidthInner)
-            prevX = x
-            prevY = y
+        r = self.pointerRadius
+        self.pointer_im = PIL.Image.new('RGBA', (2*r + 1, 2*r + 1), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(self.pointer_im)
+        draw.ellipse([(0, 0), (2*r, 2*r)], fill=(255, 0, 0, 255), width=6)
         del draw
 # ------------------------------------------------------------------------
-    def draw(self, img, dataRecord):
-        curMap = self.getCurMap(dataRecord)
-        img.paste(curMap, self.pos, curMap)
-        del curMap
+    def bbox(self):
+        return (self.pos[0], self.pos[1], self.size[0], self.size[1])
+# ------------------------------------------------------------------------
+    def pointerLayer(self, pos):
+        # The pointer is clipped to the map area like it was drawn on the map
+        x, y = int(pos[0]), int(pos[1])
+        x0, y0 = max(x, self.pos[0]), max(y, self.pos[1])
+        x1 = min(x + self.pointer_im.size[0], self.pos[0] + self.size[0])
+        y1 = min(y + self.pointer_im.size[1], self.pos[1] + self.size[1])
+        if (x1 - x0, y1 - y0) == self.pointer_im.size:
+            return (self.pointer_im, (x, y), self.pointer_im)
+        im = self.pointer_im.crop((x0 - x, y0 - y, x1 - x, y1 - y))
+        return (im, (x0, y0), im)
+# ------------------------------------------------------------------------
+    def stateKey(self, dataRecord):
+        return self.pointerPos(dataRecord)
+# ------------------------------------------------------------------------
+    def layers(self, dataRecord):
+        # Static map as is, no per-frame copy. Only the pointer moves
+        return [(self.mapImg, self.pos, self.mapImg), self.pointerLayer(self.pointerPos(dataRecord))]
 # ------------------------------------------------------------------------
     def position(self, pos, size):
         self.pos = pos
@@ -93,6 +251,7 @@ class Map (Widget):
 # ------------------------------------------------------------------------
     def clear(self):    
         del self.mapImg
+        del self.pointer_im
         Widget.clear(self)
 # ------------------------------------------------------------------------
     def IMPL01(pos, size):
@@ -111,39 +270,114 @@ class Map (Widget):
         return mp
 ##########################################################################
 class Speedometer (Widget):
-    def __init__(self, boardFile, arrowFile, topwardSpeedValueKmh, kmh2degScale, minValKmh, maxValKmh):
+    '''
+    Board with a rotating needle. Rotated needle sprites are cached per
+    needle angle quantized to [angleStep] degrees, so a frame costs one
+    lookup and two pastes (board, then needle) instead of a bitmap
+    rotation. The two aren't pre-composited: pasted separately they blend
+    into the frame exactly like the original drawing did. With [eagerCache]
+    all the angles between minValKmh and maxValKmh are rendered in
+    prepare(), otherwise sprites are rendered on demand and at most
+    [maxSprites] of them are kept (least recently used are dropped). Note a
+    600x600 sprite takes 1.4 MB, so a full eager cache at 0.25 deg is over
+    a gigabyte.
+    '''
+    def __init__(self, boardFile, arrowFile, topwardSpeedValueKmh, kmh2degScale, minValKmh, maxValKmh, angleStep=0.25, eagerCache=False, maxSprites=64):
         Widget.__init__(self)
-        self.speed_im = PIL.Image.open(boardFile)
-        self.arrow_im = PIL.Image.open(arrowFile)
+        # Load right away: lazily loaded files can't be shared with worker processes
+        self.speed_im = PIL.Image.open(boardFile).convert('RGBA')
+        self.arrow_im = PIL.Image.open(arrowFile).convert('RGBA')
         self.topwardSpeedValueKmh = topwardSpeedValueKmh
         self.kmh2degScale = kmh2degScale
         self.minValKmh = minValKmh
         self.maxValKmh = maxValKmh
+        self.angleStep = angleStep
+        self.eagerCache = eagerCache
+        self.maxSprites = maxSprites
+        self.sprites = OrderedDict()
+        self.spriteHits = 0
+        self.spriteMisses = 0
 # ------------------------------------------------------------------------
-    def draw(self, img, dataRecord):
-        speed = dataRecord['vel_filt']
+    def angleIndex(self, speed):
         if speed < self.minValKmh:
             speed = self.minValKmh
         if speed > self.maxValKmh:
             speed = self.maxValKmh
         
         angle = -float(speed - self.topwardSpeedValueKmh)*self.kmh2degScale
-
-        img.paste(self.speed_im, self.pos, self.speed_im)
-        arr_im = self.arrow_im.rotate(angle)
-        img.paste(arr_im, self.pos, arr_im)
+        return int(round(angle/self.angleStep))
+# ------------------------------------------------------------------------
+    def frameAngleIndex(self, dataRecord):
+        ind = self.frameState(dataRecord)
+        return self.angleIndex(dataRecord['vel_filt']) if ind is None else ind
+# ------------------------------------------------------------------------
+    def prepareTimeline(self, timeline):
+        # Same as angleIndex() for every frame: both round half to even
+        if not 'vel_filt' in timeline.fields:
+            return
+        speed = np.clip(timeline.fields['vel_filt'], self.minValKmh, self.maxValKmh)
+        angle = -(speed - self.topwardSpeedValueKmh)*self.kmh2degScale
+        self.timelineState = np.round(angle/self.angleStep).astype(np.int64).tolist()
+# ------------------------------------------------------------------------
+    def makeSprite(self, angleInd):
+        return self.arrow_im.rotate(angleInd*self.angleStep)
+# ------------------------------------------------------------------------
+    def getSprite(self, angleInd):
+        sprite = self.sprites.get(angleInd)
+        if not sprite is None:
+            self.spriteHits += 1
+            self.sprites.move_to_end(angleInd)
+            return sprite
         
-        del arr_im
+        self.spriteMisses += 1
+        sprite = self.makeSprite(angleInd)
+        self.sprites[angleInd] = sprite
+        if not self.eagerCache and len(self.sprites) > self.maxSprites:
+            self.sprites.popitem(last=False)
+        return sprite
+# ------------------------------------------------------------------------
+    def prepare(self, fullData):
+        Widget.prepare(self, fullData)
+        self.sprites.clear()
+        if self.eagerCache:
+            i1 = self.angleIndex(self.minValKmh)
+            i2 = self.angleIndex(self.maxValKmh)
+            for ind in range(min(i1, i2), max(i1, i2) + 1):
+                self.sprites[ind] = self.makeSprite(ind)
+# ------------------------------------------------------------------------
+    def stats(self):
+        res = {
+            'sprites': len(self.sprites),
+            'spriteCacheMB': round(len(self.sprites)*self.arrow_im.size[0]*self.arrow_im.size[1]*4/(1024*1024), 1),
+            'spriteHits': self.spriteHits,
+            'spriteMisses': self.spriteMisses,
+            }
+        res.update(Widget.stats(self))
+        return res
+# ------------------------------------------------------------------------
+    def bbox(self):
+        w = max(self.speed_im.size[0], self.arrow_im.size[0])
+        h = max(self.speed_im.size[1], self.arrow_im.size[1])
+        return (self.pos[0], self.pos[1], w, h)
+# ------------------------------------------------------------------------
+    def stateKey(self, dataRecord):
+        return self.frameAngleIndex(dataRecord)
+# ------------------------------------------------------------------------
+    def layers(self, dataRecord):
+        sprite = self.getSprite(self.frameAngleIndex(dataRecord))
+        return [(self.speed_im, self.pos, self.speed_im), (sprite, self.pos, sprite)]
 # ------------------------------------------------------------------------
     def position(self, pos, scale=1.0):
         if not scale == 1.0:
             self.speed_im = self.speed_im.resize((int(self.speed_im.size[0]*scale), int(self.speed_im.size[1]*scale)), resample=PIL.Image.LANCZOS)
             self.arrow_im = self.arrow_im.resize((int(self.arrow_im.size[0]*scale), int(self.arrow_im.size[1]*scale)), resample=PIL.Image.LANCZOS)
         self.pos = pos
+        self.sprites.clear()
 # ------------------------------------------------------------------------
     def clear(self):    
         del self.speed_im
         del self.arrow_im
+        del self.sprites
         Widget.clear(self)
 # ------------------------------------------------------------------------
     def IMPL01(pos, scale=1.0):
@@ -195,22 +429,36 @@ class HeartRate (Widget):
         if (self.styleType != 1):
             self.styleType = 1
 # ------------------------------------------------------------------------
-    def draw(self, img, dataRecord):
+    def bbox(self):
+        if self.styleType == 1:
+            return self.box
+        else:
+            return None
+# ------------------------------------------------------------------------
+    def value(self, dataRecord):
+        hr = self.frameState(dataRecord)
+        if not hr is None:
+            return hr
         hr = dataRecord['hr']
         if hr < self.minValHR:
             hr = self.minValHR
         if hr > self.maxValHR:
             hr = self.maxValHR
             
-        hr = int(hr)
-        
+        return int(hr)
+# ------------------------------------------------------------------------
+    def prepareTimeline(self, timeline):
+        if 'hr' in timeline.fields:
+            self.timelineState = np.clip(timeline.fields['hr'], self.minValHR, self.maxValHR).astype(np.int64).tolist()
+# ------------------------------------------------------------------------
+    def stateKey(self, dataRecord):
+        return self.value(dataRecord)
+# ------------------------------------------------------------------------
+    def layers(self, dataRecord):
         if self.styleType == 1:
-            img.paste(self.heart_im, self.pos, self.heart_im)
-            draw = ImageDraw.Draw(img) 
-            draw.text(self.textPos, str(hr) + ' bpm', font=self.font, fill=(255,0,0,255))
-            del draw
+            return [(self.heart_im, self.pos, self.heart_im), self.text.layer(str(self.value(dataRecord)) + ' bpm', self.textPos)]
         else:
-            pass
+            return Widget.layers(self, dataRecord)
 # ------------------------------------------------------------------------
     def position(self, pos, scale=1.0):
         
@@ -221,15 +469,38 @@ class HeartRate (Widget):
             self.pos = (pos[0], int(pos[1] + 5*scale))
             self.textPos = (int((defaultFontSize + 3)*scale + pos[0]), pos[1])
             self.font = ImageFont.truetype('fonts/arial.ttf', int(defaultFontSize*scale))
-            self.heart_im = PIL.Image.open('images/heart300.png').resize((int(defaultFontSize*scale), int(defaultFontSize*scale)), resample=PIL.Image.LANCZOS)
+            self.heart_im = PIL.Image.open('images/heart300.png').convert('RGBA').resize((int(defaultFontSize*scale), int(defaultFontSize*scale)), resample=PIL.Image.LANCZOS)
             
+            # Every possible value is pre-rasterized, the widget area covers
+            # the heart and the widest of them
+            values = [str(v) + ' bpm' for v in range(self.minValHR, self.maxValHR + 1)]
+            textSize = TextSprites.measure(self.font, values)
+            x0 = min(self.pos[0], self.textPos[0])
+            y0 = min(self.pos[1], self.textPos[1])
+            x1 = max(self.pos[0] + self.heart_im.size[0], self.textPos[0] + textSize[0])
+            y1 = max(self.pos[1] + self.heart_im.size[1], self.textPos[1] + textSize[1])
+            self.box = (x0, y0, x1 - x0, y1 - y0)
+            
+            self.text = TextSprites(self.font, (255, 0, 0, 255), textSize)
+            self.text.prerender(values)
+            
+        else:
+            pass
+# ------------------------------------------------------------------------
+    def stats(self):
+        res = {}
+        if self.styleType == 1:
+            res = {'sprites': len(self.text.sprites), 'spriteCacheMB': round(self.text.memoryMB(), 1)}
         else:
             pass
+        res.update(Widget.stats(self))
+        return res
 # ------------------------------------------------------------------------
     def clear(self):    
         if self.styleType == 1:
             del self.font
             del self.heart_im
+            del self.text
         else:
             pass
         